@@ -6,13 +6,41 @@ https://github.com/threadreaper
 """
 
 import argparse
+import re
 import sys
 import logging
 import os
 
-import color_functions
+import client
 import utility
-import export
+
+# a -i handed over to a running daemon shouldn't wait for any of these
+batch = utility.lazy_import('batch')
+color_functions = utility.lazy_import('color_functions')
+daemon = utility.lazy_import('daemon')
+desktop = utility.lazy_import('desktop')
+export = utility.lazy_import('export')
+extract = utility.lazy_import('extract')
+library = utility.lazy_import('library')
+pipeline = utility.lazy_import('pipeline')
+stageprof = utility.lazy_import('stageprof')
+
+
+def palette_size(value):
+    """argparse type for -n"""
+    size = int(value)
+    if not extract.MIN_COLORS <= size <= extract.MAX_COLORS:
+        raise argparse.ArgumentTypeError(
+            "must be between %s and %s" % (extract.MIN_COLORS,
+                                           extract.MAX_COLORS))
+    return size
+
+
+def hex_color(value):
+    """argparse type for colors given as #rrggbb"""
+    if not re.fullmatch(r'#?[0-9a-fA-F]{6}', value):
+        raise argparse.ArgumentTypeError("%s isn't a #rrggbb color" % value)
+    return '#' + value.lstrip('#').lower()
 
 
 def get_args():
@@ -23,12 +51,52 @@ def get_args():
     arg.add_argument("-i", metavar="\"/path/to/image\"",
                      help="Image file to use for theme generation.")
 
+    arg.add_argument("--backend", choices=sorted(extract.BACKENDS),
+                     default="kmeans",
+                     help="Palette extraction backend (default: kmeans).")
+
+    arg.add_argument("-n", metavar="COLORS", type=palette_size,
+                     default=extract.COLORS,
+                     help="Palette size, %s to %s (default: %s).  "
+                          "Terminals always get 16 colors, wrapped or "
+                          "sampled from the palette."
+                          % (extract.MIN_COLORS, extract.MAX_COLORS,
+                             extract.COLORS))
+
+    arg.add_argument("--pixels", metavar="N", type=int,
+                     help="Pixel budget the image is downsampled to before "
+                          "extraction (default: %s, or %s for the "
+                          "histogram backend; not used by colorz)."
+                          % (extract.MAX_PIXELS, extract.HISTOGRAM_PIXELS))
+
+    arg.add_argument("--max-memory", metavar="MiB", type=int,
+                     default=extract.MAX_MEMORY >> 20,
+                     help="Refuse images that would take more than this "
+                          "to decode, 0 for no limit.  Only JPEGs are "
+                          "decoded at reduced size; other formats over "
+                          "the limit are refused, not sampled (not used "
+                          "by colorz, default: %s)."
+                          % (extract.MAX_MEMORY >> 20))
+
+    arg.add_argument("--no-cache", action="store_true",
+                     help="Don't read or write the palette cache.")
+
+    arg.add_argument("--no-daemon", action="store_true",
+                     help="Don't hand -i over to a running SkinIt daemon.")
+
+    arg.add_argument("--no-contrast", action="store_true",
+                     help="Don't adjust colors that are hard to read on "
+                          "the background.")
+
     arg.add_argument("-l", action="store_true",
                      help="Generate a light colorscheme.")
 
     arg.add_argument("--vte", action="store_true",
                      help="Fix text-artifacts printed in VTE terminals.")
 
+    arg.add_argument("--256", dest="extended", action="store_true",
+                     help="Also remap terminal colors 16-255 to the theme.")
+
     arg.add_argument("-s", action="store_true",
                      help="Also set the splash (login) screen wallpaper.")
 
@@ -41,9 +109,132 @@ def get_args():
     arg.add_argument("-r", metavar="[name of theme]",
                      help="Switch Plasma theme")
 
+    arg.add_argument("--desktop", choices=sorted(desktop.BACKENDS),
+                     default="plasma",
+                     help="Desktop to talk to (default: plasma). 'fake' "
+                          "only records requests, for testing.")
+
+    arg.add_argument("--profile", choices=stageprof.FORMATS,
+                     help="Print the time and memory each stage took, as "
+                          "json or a table.  Skips the daemon.")
+
+    arg.add_argument("--profile-stage", choices=stageprof.STAGES,
+                     help="Also run this stage under cProfile.")
+
+    arg.add_argument("--profile-output", metavar="FILE",
+                     help="Where to dump the cProfile stats (default: "
+                          "skinit-STAGE.prof).")
+
+    commands = arg.add_subparsers(dest="command", metavar="command")
+
+    batch_arg = commands.add_parser(
+        "batch", help="Generate palettes and themes for a whole directory "
+                      "of wallpapers.")
+
+    batch_arg.add_argument("source", metavar="\"/path/to/images\"",
+                           help="Directory or glob of image files.")
+
+    batch_arg.add_argument("-o", metavar="\"/path/to/output\"",
+                           default="skinit-batch",
+                           help="Folder to write results to.")
+
+    batch_arg.add_argument("-j", metavar="N", type=int,
+                           help="Number of worker processes "
+                                "(default: one per core).")
+
+    batch_arg.add_argument("--skip-existing", action="store_true",
+                           help="Skip images whose results are up to date.")
+
+    daemon_arg = commands.add_parser(
+        "daemon", help="Stay running, keep caches warm and re-theme when "
+                       "the wallpaper changes.")
+
+    daemon_arg.add_argument("--drop-dir", metavar="\"/path/to/folder\"",
+                            help="Re-theme from images dropped in here "
+                                 "(default: ~/.local/share/skinit/drop).")
+
+    daemon_arg.add_argument("--no-watch-config", action="store_true",
+                            help="Don't follow wallpaper changes made in "
+                                 "Plasma.")
+
+    daemon_arg.add_argument("--poll", action="store_true",
+                            help="Poll for changes instead of using "
+                                 "inotify.")
+
+    library_arg = commands.add_parser(
+        "library", help="Index the palettes of a wallpaper collection and "
+                        "find wallpapers by color.")
+
+    library_arg.add_argument("-u", metavar="\"/path/to/images\"",
+                             help="Index new and changed images in a "
+                                  "directory (or glob).")
+
+    library_arg.add_argument("-j", metavar="N", type=int,
+                             help="Number of worker processes for -u "
+                                  "(default: one per core).")
+
+    library_arg.add_argument("--color", metavar="\"#rrggbb\"",
+                             type=hex_color,
+                             help="Find wallpapers with a color close to "
+                                  "this one.")
+
+    library_arg.add_argument("--like", metavar="\"/path/to/image\"",
+                             help="Find wallpapers whose palette is close "
+                                  "to this image's.")
+
+    library_arg.add_argument("--palette", metavar="\"#rrggbb\"",
+                             type=hex_color, nargs="+",
+                             help="Find wallpapers whose palette is close "
+                                  "to these colors.")
+
+    library_arg.add_argument("--current", action="store_true",
+                             help="Find wallpapers whose palette is close "
+                                  "to the current wallpaper's.")
+
+    library_arg.add_argument("-k", metavar="N", type=int,
+                             default=library.RESULTS,
+                             help="Number of wallpapers to list "
+                                  "(default: %(default)s).")
+
     return arg
 
 
+def query_library(args, options):
+    """update and search the palette library as the library command
+    asked.  Returns False if something went wrong"""
+    failures = []
+    with library.Library() as index:
+        if args.u:
+            failures = index.update(args.u, jobs=args.j, quiet=args.q,
+                                    **options)
+        colors = args.palette
+        img = os.path.abspath(args.like) if args.like else None
+        if args.current:
+            img = daemon.current_wallpaper()
+            if not img:
+                logging.error("Couldn't find the current wallpaper.")
+                return False
+        if img:
+            colors = index.palette(img)
+            if colors is None:
+                try:
+                    colors = color_functions.get(img, **options).hex
+                except (OSError, extract.ExtractionError) as e:
+                    logging.error(e)
+                    return False
+        if args.color:
+            results = index.near_color(args.color, args.k)
+        elif colors:
+            results = index.near_palette(colors, args.k)
+        else:
+            results = []
+    for distance, path, palette in results:
+        strip = ''.join("\033[48;2;%s;%s;%sm  " % tuple(rgb) for rgb in
+                        color_functions.Palette.from_hex(palette).rgb)
+        print("%s\033[0m %6.1f  %s" % (strip, distance, path))
+    return not failures
+
+
 def parse_args_exit(parser):
     """Process args that exit."""
     args = parser.parse_args()
@@ -61,21 +252,74 @@ def parse_args_exit(parser):
         color_functions.palette()
         sys.exit(0)
 
+    desktop.use(args.desktop)
+
+    if args.profile or args.profile_stage:
+        stageprof.start(cprofile_stage=args.profile_stage,
+                        cprofile_output=args.profile_output)
+
     if args.r:
-        export.update_theme(args.red)
-        logging.info("Switching theme to %s.", args.red)
+        export.update_theme(args.r)
+        with stageprof.stage('reload'):
+            desktop.backend().flush()
+        logging.info("Switching theme to %s.", args.r)
 
 
 def parse_args(parser):
     """Process args"""
     args = parser.parse_args()
 
+    if args.command == "batch":
+        failures = batch.run(args.source, args.o, jobs=args.j,
+                             skip_existing=args.skip_existing, quiet=args.q,
+                             backend=args.backend, n=args.n,
+                             readable=not args.no_contrast,
+                             use_cache=not args.no_cache,
+                             max_pixels=args.pixels,
+                             max_memory=args.max_memory << 20)
+        sys.exit(1 if failures else 0)
+
+    options = {"splash": args.s, "vte_fix": args.vte,
+               "extended": args.extended, "backend": args.backend,
+               "n": args.n, "readable": not args.no_contrast,
+               "use_cache": not args.no_cache, "max_pixels": args.pixels,
+               "max_memory": args.max_memory << 20}
+
+    if args.command == "library":
+        for option in ("splash", "vte_fix", "extended", "readable"):
+            del options[option]
+        sys.exit(0 if query_library(args, options) else 1)
+
+    if args.command == "daemon":
+        del options["splash"]
+        daemon.Daemon(drop_dir=os.path.abspath(args.drop_dir or
+                                               daemon.DROP_DIR),
+                      watch_config=not args.no_watch_config,
+                      poll=args.poll, **options).run()
+        sys.exit(0)
+
     if args.i:
-        img = utility.get_image(args.i)
-        export.export_wallpaper(img, args.s)
-        colors = color_functions.get(args.i)
-        export.make_theme_files(img, colors)
-        export.send(colors, to_send=not args.s, vte_fix=args.vte, quiet=args.q)
+        img = os.path.abspath(utility.get_image(args.i))
+        answer = None
+        if not (args.no_daemon or args.profile or args.profile_stage):
+            answer = client.request({"cmd": "apply", "image": img,
+                                     "options": options})
+        if answer is not None:
+            if not answer["ok"]:
+                logging.error(answer["error"])
+                sys.exit(1)
+            if not args.q:
+                color_functions.palette()
+        else:
+            try:
+                pipeline.apply(img, quiet=args.q, **options)
+            except extract.ExtractionError as e:
+                logging.error(e)
+                sys.exit(1)
+
+    profiler = stageprof.stop()
+    if profiler and args.profile:
+        print(profiler.report(args.profile), file=sys.stderr)
 
     if args.q:
         logging.getLogger().disabled = True
@@ -0,0 +1,131 @@
+"""
+Batch mode: generate palettes and rendered templates for a whole
+directory (or glob) of wallpapers.  Images are farmed out to a process
+pool, and each image's results are written to its own folder in the
+output tree as soon as it finishes:
+
+    <output>/<image path relative to the input>/palette.json
+    <output>/<image path relative to the input>/<template name>
+
+A failed image is logged and added to the failure list rather than
+stopping the run.
+"""
+import functools
+import glob
+import json
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import color_functions
+import contrast
+import render
+from utility import atomic_write, create_dir
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp', '.gif', '.tif',
+                    '.tiff', '.webp')
+
+
+def find_images(source):
+    """image files in a directory (recursively) or matching a glob"""
+    if os.path.isdir(source):
+        found = []
+        for root, _, files in os.walk(source):
+            found.extend(os.path.join(root, file) for file in files)
+    else:
+        found = glob.glob(os.path.expanduser(source), recursive=True)
+    return sorted(os.path.abspath(file) for file in found
+                  if file.lower().endswith(IMAGE_EXTENSIONS)
+                  and os.path.isfile(file))
+
+
+def output_dirs(images, output):
+    """map each image to its own folder in the output tree, mirroring
+    the layout of the input.  Folders keep the image's extension, so
+    a.jpg and a.png next to each other don't share one"""
+    if not images:
+        return {}
+    base = os.path.commonpath(images)
+    if len(images) == 1:
+        base = os.path.dirname(base)
+    return {img: os.path.join(output, os.path.relpath(img, base))
+            for img in images}
+
+
+def up_to_date(img, target):
+    """True if target already holds results newer than img"""
+    palette_file = os.path.join(target, 'palette.json')
+    try:
+        return os.path.getmtime(palette_file) >= os.path.getmtime(img)
+    except OSError:
+        return False
+
+
+def farm_out(worker, tasks, failures, jobs=None, quiet=False):
+    """run worker(*args) for every key => args of tasks on a process pool,
+    logging progress, and yield (key, result) for each as it finishes.
+    The ones that raise are logged and added to failures as (key, error
+    message) pairs instead"""
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        pending = {pool.submit(worker, *args): key
+                   for key, args in tasks.items()}
+        for done, future in enumerate(as_completed(pending), 1):
+            key = pending[future]
+            try:
+                result = future.result()
+            except Exception as e:  # pylint: disable=broad-except
+                failures.append((key, str(e)))
+                logging.error("[%s/%s] %s: %s", done, len(tasks), key, e)
+                continue
+            if not quiet:
+                logging.info("[%s/%s] %s", done, len(tasks), key)
+            yield key, result
+
+
+def process(img, target, backend='kmeans', use_cache=True, readable=True,
+            **options):
+    """worker: extract, sort and render a single image into target.
+    Returns the palette as a list of hex strings"""
+    colors = color_functions.get(img, backend, use_cache=use_cache,
+                                 **options)
+    if readable:
+        colors = contrast.enforce(colors)
+    create_dir(target)
+    for template, _, text in render.render_all(img, colors):
+        atomic_write(text, os.path.join(target,
+                                        render.template_name(template)))
+    palette = [color.hex_value for color in colors]
+    # written last, so its mtime marks the image as done
+    atomic_write(json.dumps({'wallpaper': img, 'colors': palette},
+                            indent=4),
+                 os.path.join(target, 'palette.json'))
+    return palette
+
+
+def run(source, output, jobs=None, skip_existing=False, quiet=False,
+        **options):
+    """process every image found in source into the output folder.
+    Returns a list of (image, error message) pairs for the failures"""
+    images = find_images(source)
+    if not images:
+        logging.error("No images found in %s.", source)
+        return [(source, "No images found.")]
+    targets = output_dirs(images, output)
+    if skip_existing:
+        todo = [img for img in images if not up_to_date(img, targets[img])]
+        if not quiet:
+            logging.info("Skipping %s up to date images.",
+                         len(images) - len(todo))
+        images = todo
+
+    failures = []
+    worker = functools.partial(process, **options)
+    for _ in farm_out(worker, {img: (img, targets[img]) for img in images},
+                      failures, jobs, quiet):
+        pass
+
+    if failures:
+        logging.error("%s of %s images failed:", len(failures), len(images))
+        for img, error in failures:
+            logging.error("  %s: %s", img, error)
+    return failures
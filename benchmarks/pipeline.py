@@ -0,0 +1,305 @@
+"""
+Pipeline benchmark.  Times each stage of a theme change in isolation,
+and the whole thing end to end, on deterministic synthetic wallpapers
+and palettes.
+
+    python benchmarks/pipeline.py [-n RUNS] [--sizes 1080p,4k]
+                                  [--palettes 16,64] [-o results.json]
+    python benchmarks/pipeline.py --compare OLD.json NEW.json
+                                  [--threshold 0.1]
+
+Stages:
+    extract      extract.extract on each image size
+    histogram    the histogram backend on each image size, without its
+                 histogram cache
+    get          color_functions.get, uncached (extraction plus sort)
+    palette      color_functions.get on the first image size, for each
+                 palette size
+    sort         colorsort.sort_colors on each palette size
+    render       every template rendered and written to a scratch folder
+    sequences    export.create_sequences, colors 0-255
+    end_to_end   get, render, desktop flush (fake backend) and a
+                 broadcast to a pseudo terminal, on each image size
+
+For each image size the report also gives the accuracy of the bounded
+image loader: the CIEDE2000 distance from each color of the normal
+palette to the nearest color of a palette extracted from the fully
+decoded image (a uniform sample of up to REFERENCE_PIXELS of it), next
+to the distance between two such full-decode palettes.
+
+Each case reports the median and minimum wall time over RUNS timed
+runs (after one untimed warm-up) and the tracemalloc peak of a separate
+run.  tracemalloc sees Python and numpy allocations, not Pillow's
+decode buffers.  --compare exits with status 1 if any case got slower
+(or hungrier) than the threshold allows.
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+PACKAGE = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, PACKAGE)
+
+# pylint: disable=wrong-import-position
+import broadcast  # noqa: E402
+import color_functions  # noqa: E402
+import colorspace  # noqa: E402
+import colorsort  # noqa: E402
+import deltae  # noqa: E402
+import desktop  # noqa: E402
+import export  # noqa: E402
+import extract  # noqa: E402
+import histogram  # noqa: E402
+from render import render_all  # noqa: E402
+from utility import atomic_write, lazy_import  # noqa: E402
+
+np = lazy_import('numpy')
+Image = lazy_import('PIL.Image')
+
+IMAGE_SIZES = {
+    '1080p': (1920, 1080),
+    '1440p': (2560, 1440),
+    '4k': (3840, 2160),
+    '8k': (7680, 4320),
+}
+PALETTE_SIZES = (8, 16, 64, 128, 256)
+THRESHOLD = 0.10
+REFERENCE_PIXELS = 1 << 20
+
+
+def synthetic_image(size, path, seed=0):
+    """write a deterministic wallpaper-like JPEG: smooth random color
+    fields, upscaled from a coarse grid"""
+    width, height = size
+    rng = np.random.default_rng(seed)
+    coarse = rng.integers(0, 256, (max(2, height // 120),
+                                   max(2, width // 120), 3), dtype=np.uint8)
+    image = Image.fromarray(coarse).resize(size, Image.BICUBIC)
+    image.save(path, quality=90)
+    return path
+
+
+def synthetic_palette(n, seed=0):
+    """n deterministic random colors"""
+    rng = np.random.default_rng(seed)
+    return color_functions.Palette(rng.integers(0, 256, (n, 3),
+                                                dtype=np.uint8))
+
+
+def _palette_distance(colors, reference):
+    """mean and max CIEDE2000 distance from each color to the nearest
+    reference color"""
+    distances = deltae.ciede2000(colorspace.rgb_to_lab(colors)[:, None],
+                                 colorspace.rgb_to_lab(reference)[None, :])
+    nearest = distances.min(axis=1)
+    return float(nearest.mean()), float(nearest.max())
+
+
+def accuracy(img):
+    """how far the bounded loader's palette is from full-decode palettes.
+    k-means on two different samples of the full decode disagrees by
+    itself, so that distance is reported too, as the noise floor"""
+    with Image.open(img) as image:
+        full = np.asarray(image.convert('RGB')).reshape(-1, 3)
+    references = []
+    for seed in (0, 1):
+        rng = np.random.default_rng(seed)
+        sample = full[rng.integers(len(full), size=min(len(full),
+                                                       REFERENCE_PIXELS))]
+        references.append(extract.kmeans(sample.astype(np.float32), 16))
+    bounded = extract.kmeans(extract.load_pixels(img), 16)
+    mean, worst = _palette_distance(bounded, references[0])
+    noise, _ = _palette_distance(references[1], references[0])
+    return {'mean_delta_e': mean, 'max_delta_e': worst,
+            'noise_delta_e': noise}
+
+
+def render_to(img, colors, scratch):
+    """render every template into scratch instead of its destination"""
+    for template, _, text in render_all(img, colors):
+        atomic_write(text, os.path.join(scratch, os.path.basename(template)))
+
+
+def end_to_end(img, scratch, terminal):
+    """pipeline.apply, minus anything outside the benchmark's sandbox"""
+    backend = desktop.use('fake')
+    backend.set_wallpaper(img)
+    colors = color_functions.get(img, use_cache=False)
+    render_to(img, colors, scratch)
+    backend.apply_colorscheme('SkinIt')
+    backend.reload_theme('SkinIt')
+    backend.flush()
+    broadcast.broadcast(export.create_sequences(colors, extended=True),
+                        [terminal])
+
+
+def drain(master):
+    """read and discard everything written to a pty, so broadcasts to it
+    never block on a full buffer.  Returns once the slave side is closed
+    (read gives EOF or EIO)"""
+    try:
+        while os.read(master, 1 << 16):
+            pass
+    except OSError:
+        pass
+
+
+def measure(function, runs):
+    """median and minimum wall time in ms and tracemalloc peak in KiB"""
+    function()
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        function()
+        times.append((time.perf_counter() - start) * 1000)
+    tracemalloc.start()
+    try:
+        function()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {'median_ms': statistics.median(times), 'min_ms': min(times),
+            'peak_kib': peak / 1024}
+
+
+def cases(images, palettes, scratch, terminal):
+    """(name, callable) for every case to measure"""
+    for label, img in images.items():
+        yield 'extract/%s' % label, lambda img=img: extract.extract(img, 16)
+        yield 'histogram/%s' % label, lambda img=img: \
+            histogram.Histogram.from_slices(extract.load_pixels(
+                img, extract.HISTOGRAM_PIXELS)).palette(16)
+        yield 'get/%s' % label, \
+            lambda img=img: color_functions.get(img, use_cache=False)
+    first = next(iter(images.values()), None)
+    for n, colors in palettes.items():
+        if first:
+            yield 'palette/%d' % n, lambda n=n: \
+                color_functions.get(first, n=n, use_cache=False)
+        yield 'sort/%d' % n, lambda colors=colors: \
+            colorsort.sort_colors(colors)
+        yield 'render/%d' % n, lambda colors=colors: \
+            render_to('/tmp/wallpaper.jpg', colors, scratch)
+        yield 'sequences/%d' % n, lambda colors=colors: \
+            export.create_sequences(colors, extended=True)
+    for label, img in images.items():
+        yield 'end_to_end/%s' % label, \
+            lambda img=img: end_to_end(img, scratch, terminal)
+
+
+def run(sizes, palette_sizes, runs):
+    """benchmark everything, returning the results document"""
+    results, accuracies = {}, {}
+    with tempfile.TemporaryDirectory(prefix='skinit-bench-') as scratch:
+        images = {label: synthetic_image(IMAGE_SIZES[label],
+                                         os.path.join(scratch,
+                                                      label + '.jpg'))
+                  for label in sizes}
+        palettes = {n: synthetic_palette(n) for n in palette_sizes}
+        master, slave = os.openpty()
+        drainer = threading.Thread(target=drain, args=(master,), daemon=True)
+        drainer.start()
+        try:
+            terminal = os.ttyname(slave)
+            for name, function in cases(images, palettes, scratch,
+                                        terminal):
+                results[name] = measure(function, runs)
+                print("%-22s %10.1f ms" % (name, results[name]['median_ms']),
+                      file=sys.stderr)
+        finally:
+            # master can only be closed once nothing reads it, or its fd
+            # number could be reused by a file the drainer then reads from
+            os.close(slave)
+            drainer.join()
+            os.close(master)
+        for label, img in images.items():
+            accuracies[label] = accuracy(img)
+            print("%-22s %10.2f mean delta E (noise %.2f)" % (
+                'accuracy/' + label, accuracies[label]['mean_delta_e'],
+                accuracies[label]['noise_delta_e']), file=sys.stderr)
+    return {
+        'meta': {'python': platform.python_version(),
+                 'numpy': np.__version__,
+                 'machine': platform.machine(),
+                 'runs': runs,
+                 'time': time.strftime('%Y-%m-%dT%H:%M:%S')},
+        'results': results,
+        'accuracy': accuracies,
+    }
+
+
+def load_results(path):
+    """a results document written by --output"""
+    with open(path, 'r') as file:
+        return json.load(file)
+
+
+def compare(old, new, threshold=THRESHOLD):
+    """rows of (case, metric, old, new, ratio, regressed) for every case
+    in both runs"""
+    rows = []
+    for name in sorted(set(old['results']) & set(new['results'])):
+        for metric in ('median_ms', 'peak_kib'):
+            before = old['results'][name][metric]
+            after = new['results'][name][metric]
+            ratio = after / before if before else float('inf')
+            rows.append((name, metric, before, after, ratio,
+                         ratio > 1 + threshold))
+    return rows
+
+
+def main():
+    """run the benchmark, or compare two earlier runs"""
+    arg = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    arg.add_argument("-n", metavar="RUNS", type=int, default=5,
+                     help="Timed runs per case (default: 5).")
+    arg.add_argument("--sizes", default=",".join(IMAGE_SIZES),
+                     help="Image sizes to test (default: all of %s)."
+                          % ",".join(IMAGE_SIZES))
+    arg.add_argument("--palettes",
+                     default=",".join(map(str, PALETTE_SIZES)),
+                     help="Palette sizes to test (default: %s)."
+                          % ",".join(map(str, PALETTE_SIZES)))
+    arg.add_argument("-o", metavar="FILE",
+                     help="Write results to FILE as JSON (default: stdout).")
+    arg.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"),
+                     help="Compare two result files instead of running.")
+    arg.add_argument("--threshold", type=float, default=THRESHOLD,
+                     help="Slowdown counted as a regression "
+                          "(default: %.2f)." % THRESHOLD)
+    args = arg.parse_args()
+
+    if args.compare:
+        old_path, new_path = args.compare
+        rows = compare(load_results(old_path), load_results(new_path),
+                       threshold=args.threshold)
+        print("%-22s %-10s %12s %12s %8s" % ("case", "metric", "old", "new",
+                                             "ratio"))
+        for name, metric, before, after, ratio, regressed in rows:
+            print("%-22s %-10s %12.1f %12.1f %7.2fx%s"
+                  % (name, metric, before, after, ratio,
+                     "  REGRESSION" if regressed else ""))
+        sys.exit(1 if any(row[-1] for row in rows) else 0)
+
+    sizes = [size.strip() for size in args.sizes.split(",") if size.strip()]
+    unknown = [size for size in sizes if size not in IMAGE_SIZES]
+    if unknown:
+        arg.error("unknown image size: %s" % ", ".join(unknown))
+    document = run(sizes, [int(n) for n in args.palettes.split(",")], args.n)
+    text = json.dumps(document, indent=4)
+    if args.o:
+        with open(args.o, 'w') as file:
+            file.write(text + '\n')
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
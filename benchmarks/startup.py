@@ -0,0 +1,92 @@
+"""
+Startup benchmark.  Measures how long each CLI path takes from a cold
+interpreter, and what each SkinIt module costs to import.
+
+    python benchmarks/startup.py [-n RUNS] [--json]
+
+Every measurement runs in a fresh subprocess, so nothing is shared
+between runs apart from the OS file cache.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+PACKAGE = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+CLI_PATHS = {
+    'help': ['--help'],
+    'preview': ['-p'],
+    'batch help': ['batch', '--help'],
+}
+
+MODULES = ['utility', 'services', 'color_functions', 'colorsort', 'extract',
+           'render', 'export', 'batch']
+
+
+def time_command(command, runs):
+    """median and minimum wall time of a command, in milliseconds"""
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run(command, cwd=PACKAGE, stdout=subprocess.DEVNULL,
+                       stderr=subprocess.DEVNULL, check=False)
+        times.append((time.perf_counter() - start) * 1000)
+    return {'median_ms': statistics.median(times), 'min_ms': min(times)}
+
+
+def import_time(module):
+    """self and cumulative import time of a module, in milliseconds,
+    as reported by python -X importtime"""
+    out = subprocess.run([sys.executable, '-X', 'importtime', '-c',
+                          'import %s' % module], cwd=PACKAGE,
+                         stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                         text=True, check=False).stderr
+    for line in reversed(out.splitlines()):
+        fields = line.split('|')
+        if len(fields) == 3 and fields[2].strip() == module:
+            return {'self_ms': int(fields[0].split(':')[1]) / 1000,
+                    'cumulative_ms': int(fields[1]) / 1000}
+    return {'error': out.strip().splitlines()[-1] if out.strip() else '?'}
+
+
+def main():
+    """run the benchmark and print the results"""
+    arg = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    arg.add_argument("-n", metavar="RUNS", type=int, default=10,
+                     help="Runs per CLI path (default: 10).")
+    arg.add_argument("--json", action="store_true",
+                     help="Print results as JSON.")
+    args = arg.parse_args()
+
+    results = {
+        'interpreter': time_command([sys.executable, '-c', 'pass'], args.n),
+        'cli': {name: time_command([sys.executable, '.', *argv], args.n)
+                for name, argv in CLI_PATHS.items()},
+        'imports': {module: import_time(module) for module in MODULES},
+    }
+
+    if args.json:
+        print(json.dumps(results, indent=4))
+        return
+
+    print("%-22s %10s %10s" % ("cold start", "median ms", "min ms"))
+    for name, result in [('(bare interpreter)', results['interpreter']),
+                         *results['cli'].items()]:
+        print("%-22s %10.1f %10.1f" % (name, result['median_ms'],
+                                       result['min_ms']))
+    print()
+    print("%-22s %10s %10s" % ("import", "self ms", "total ms"))
+    for module, result in results['imports'].items():
+        if 'error' in result:
+            print("%-22s %s" % (module, result['error']))
+        else:
+            print("%-22s %10.1f %10.1f" % (module, result['self_ms'],
+                                           result['cumulative_ms']))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,62 @@
+"""
+Writes escape sequences to many terminals at once.  Every tty is opened
+non-blocking and written from a single poll() loop, so one stuck or
+flow-controlled terminal can't hold up the rest, and none of them gets
+longer than the timeout.
+"""
+import os
+import select
+import time
+
+OK = 'ok'
+TIMEOUT = 'timeout'
+
+
+def broadcast(data, terminals, timeout=0.5):
+    """write data to every terminal in the terminals list concurrently.
+    Returns a dict of terminal path => OK, TIMEOUT or an error message"""
+    payload = data.encode() if isinstance(data, str) else data
+    results = {}
+    pending = {}  # fd => [terminal, bytes written so far]
+    poller = select.poll()
+
+    for term in terminals:
+        try:
+            fd = os.open(term, os.O_WRONLY | os.O_NONBLOCK | os.O_NOCTTY)
+        except OSError as e:
+            results[term] = e.strerror
+            continue
+        pending[fd] = [term, 0]
+        poller.register(fd, select.POLLOUT)
+
+    def finish(fd, status):
+        results[pending.pop(fd)[0]] = status
+        poller.unregister(fd)
+        os.close(fd)
+
+    deadline = time.monotonic() + timeout
+    try:
+        while pending:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            for fd, event in poller.poll(remaining * 1000):
+                if event & (select.POLLERR | select.POLLHUP |
+                            select.POLLNVAL):
+                    finish(fd, 'hung up')
+                    continue
+                offset = pending[fd][1]
+                try:
+                    offset += os.write(fd, payload[offset:])
+                except BlockingIOError:
+                    continue
+                except OSError as e:
+                    finish(fd, e.strerror)
+                    continue
+                pending[fd][1] = offset
+                if offset >= len(payload):
+                    finish(fd, OK)
+    finally:
+        for fd in list(pending):
+            finish(fd, TIMEOUT)
+    return results
@@ -0,0 +1,166 @@
+"""
+Persistent palette cache.  Sorted palettes are stored as small JSON
+files under $XDG_CACHE_HOME/skinit/palettes, named by a hash of the
+image's contents plus the extraction and sort parameters, so applying
+a wallpaper we've seen before only costs a hash and a file read.
+
+Entries are written atomically (temp file + rename), so concurrent
+SkinIt processes never see a partial entry.  Reads bump an entry's
+mtime, and once the cache grows past max_entries the least recently
+used entries are evicted under an exclusive lock.
+
+OutputDigests keeps track of what was last written to each generated
+theme file, so unchanged files don't get rewritten.
+"""
+import fcntl
+import json
+import logging
+import os
+
+from utility import atomic_write, create_dir, lazy_import
+
+hashlib = lazy_import('hashlib')
+
+CACHE_DIR = os.path.join(os.environ.get('XDG_CACHE_HOME') or
+                         os.path.expanduser('~/.cache'), 'skinit')
+MAX_ENTRIES = 512
+# entries kept in memory by long-running processes
+MEMORY_ENTRIES = 256
+
+
+_hashes = {}
+
+
+def _remember(memo, key, value):
+    """store in a bounded in-memory dict, dropping the oldest entry"""
+    memo[key] = value
+    if len(memo) > MEMORY_ENTRIES:
+        del memo[next(iter(memo))]
+
+
+def image_hash(img, chunk_size=1 << 20):
+    """fast content hash of an image file.  Hashes are remembered for
+    as long as the file's size and mtime stay the same, so long-running
+    processes don't re-read images they've already seen"""
+    stat = os.stat(img)
+    memo_key = (os.path.abspath(img), stat.st_size, stat.st_mtime_ns)
+    if memo_key in _hashes:
+        return _hashes[memo_key]
+    digest = hashlib.blake2b(digest_size=16)
+    with open(img, 'rb') as file:
+        for chunk in iter(lambda: file.read(chunk_size), b''):
+            digest.update(chunk)
+    _remember(_hashes, memo_key, digest.hexdigest())
+    return _hashes[memo_key]
+
+
+def evict(directory, max_entries, suffix):
+    """delete the least recently used files ending in suffix from
+    directory, keeping max_entries, under an exclusive lock"""
+    with open(os.path.join(directory, '.lock'), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        entries = []
+        with os.scandir(directory) as scan:
+            for entry in scan:
+                if not entry.name.endswith(suffix):
+                    continue
+                try:
+                    entries.append((entry.stat().st_mtime, entry.path))
+                except FileNotFoundError:
+                    pass
+        entries.sort(reverse=True)
+        for _, path in entries[max_entries:]:
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            else:
+                logging.debug("Evicted %s from cache.", path)
+
+
+class PaletteCache:
+    """LRU cache of sorted hex palettes, one file per entry, with the
+    entries this instance has seen also kept in memory"""
+
+    def __init__(self, directory=None, max_entries=MAX_ENTRIES):
+        self.directory = os.path.join(directory or CACHE_DIR, 'palettes')
+        self.max_entries = max_entries
+        self.memory = {}
+        create_dir(self.directory)
+
+    @staticmethod
+    def key(img, **params):
+        """cache key for an image and the parameters used to get its
+        palette"""
+        params = json.dumps(params, sort_keys=True, default=str)
+        return hashlib.blake2b((image_hash(img) + params).encode(),
+                               digest_size=16).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + '.json')
+
+    def get(self, key):
+        """returns the cached palette for key, or None"""
+        if key in self.memory:
+            return self.memory[key]
+        path = self._path(key)
+        try:
+            with open(path, 'r') as file:
+                palette = json.load(file)['palette']
+            os.utime(path)
+        except (OSError, ValueError, KeyError):
+            return None
+        _remember(self.memory, key, palette)
+        return palette
+
+    def put(self, key, palette):
+        """store a palette (a list of hex strings) under key"""
+        atomic_write(json.dumps({'palette': list(palette)}), self._path(key))
+        _remember(self.memory, key, list(palette))
+        self.evict()
+
+    def evict(self):
+        """drop least recently used entries beyond max_entries"""
+        evict(self.directory, self.max_entries, '.json')
+
+
+class OutputDigests:
+    """remembers a digest, size and mtime for every file SkinIt writes,
+    so unchanged output can be recognised from a stat() alone"""
+
+    def __init__(self, directory=None):
+        self.path = os.path.join(directory or CACHE_DIR, 'outputs.json')
+        self.changed = False
+        try:
+            with open(self.path, 'r') as file:
+                self.digests = json.load(file)
+        except (OSError, ValueError):
+            self.digests = {}
+
+    @staticmethod
+    def digest(data):
+        """digest of some rendered text"""
+        return hashlib.blake2b(data.encode(), digest_size=16).hexdigest()
+
+    def unchanged(self, output, digest):
+        """True if output is known to hold content with this digest and
+        hasn't been touched since"""
+        try:
+            stat = os.stat(output)
+        except OSError:
+            return False
+        return self.digests.get(output) == [digest, stat.st_size,
+                                            stat.st_mtime_ns]
+
+    def record(self, output, digest):
+        """remember that output now holds content with this digest"""
+        stat = os.stat(output)
+        self.digests[output] = [digest, stat.st_size, stat.st_mtime_ns]
+        self.changed = True
+
+    def save(self):
+        """write the digests back to disk, if anything was recorded"""
+        if self.changed:
+            create_dir(os.path.dirname(self.path))
+            atomic_write(json.dumps(self.digests), self.path)
+            self.changed = False
@@ -0,0 +1,32 @@
+"""
+The client side of the daemon's socket.  Kept apart from daemon.py so
+that handing -i over to a running daemon only needs json and socket,
+not the modules that do the theming.
+"""
+import json
+import os
+import socket
+
+from utility import lazy_import
+
+tempfile = lazy_import('tempfile')
+
+SOCKET_PATH = os.path.join(os.environ.get('XDG_RUNTIME_DIR') or
+                           tempfile.gettempdir(), 'skinit.sock')
+
+
+def request(payload, socket_path=SOCKET_PATH, timeout=60):
+    """send one request to a running daemon.  Returns its answer, or None
+    if no daemon is listening"""
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    client.settimeout(timeout)
+    try:
+        client.connect(socket_path)
+    except OSError:
+        client.close()
+        return None
+    with client, client.makefile('rwb') as stream:
+        stream.write(json.dumps(payload).encode() + b'\n')
+        stream.flush()
+        answer = stream.readline()
+    return json.loads(answer) if answer else None
@@ -1,24 +1,32 @@
 """
-Contains the Color class object which can be instantiated with a
-color code in hex string format, such as #FFFFFF.  Extends methods
-to return that color's value in hex, or converted to either rgb
-or hsv color space.
+Contains the Palette class, an array-backed set of colors, and the
+Color class object which can be instantiated with a color code in hex
+string format, such as #FFFFFF, or taken as a view of one color in a
+Palette.  Extends methods to return that color's value in hex, or
+converted to rgb, hsv or lab color space.
 
 Also contains functions involved in sorting a list of colors, and
 doing other format conversions outside the scope of the Color
 class.
 """
-import logging
-import subprocess
-import sys
 from math import sqrt
 
-import colorsort
+import extract
+import stageprof
+from utility import lazy_import
+
+cache = lazy_import('cache')
+colorsort = lazy_import('colorsort')
+colorspace = lazy_import('colorspace')
+np = lazy_import('numpy')
+
+_palette_cache = None
 
 
 def palette(*args):
     """Generate a preview palette to be displayed in the terminal.
-    Expects a list of 16 Color objects as input"""
+    With no arguments, shows the terminal's 16 colors; otherwise
+    expects a list of Color objects (any number) as input"""
     if not args:
         for i in range(16):
             if i % 8 == 0:
@@ -36,67 +44,126 @@ def palette(*args):
         print()
 
 
+class Palette:
+    """An ordered set of colors stored as an (N, 3) uint8 rgb array.
+       The hex, hsv and lab forms of the whole palette are worked out
+       in one vectorized pass the first time they're asked for, and
+       cached.  Indexing or iterating gives Color views into it."""
+
+    def __init__(self, rgb):
+        self.rgb = np.asarray(rgb, dtype=np.uint8).reshape(-1, 3)
+        self._hex = self._hsv = self._lab = None
+
+    @classmethod
+    def from_hex(cls, hex_colors):
+        """build a palette from a list of hex strings"""
+        colors = cls(colorspace.hex_to_rgb(hex_colors))
+        colors._hex = ['#' + color.lstrip('#').lower()
+                       for color in hex_colors]
+        return colors
+
+    @classmethod
+    def from_colors(cls, colors):
+        """build a palette from any iterable of Color objects, reusing
+        it if it's already a Palette"""
+        if isinstance(colors, cls):
+            return colors
+        colors = list(colors)
+        if not colors:
+            return cls(np.empty((0, 3)))
+        return cls(np.array([color.rgb_value for color in colors]))
+
+    @property
+    def hex(self):
+        """list of '#rrggbb' strings"""
+        if self._hex is None:
+            self._hex = colorspace.rgb_to_hex(self.rgb)
+        return self._hex
+
+    @property
+    def hsv(self):
+        """(N, 3) array of hsv values"""
+        if self._hsv is None:
+            self._hsv = colorspace.rgb_to_hsv(self.rgb)
+        return self._hsv
+
+    @property
+    def lab(self):
+        """(N, 3) array of CIELab values"""
+        if self._lab is None:
+            self._lab = colorspace.rgb_to_lab_cached(self.rgb)
+        return self._lab
+
+    def __len__(self):
+        return len(self.rgb)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return Palette(self.rgb[index])
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('palette index out of range')
+        return Color(colors=self, index=index)
+
+    def __iter__(self):
+        return (Color(colors=self, index=i) for i in range(len(self)))
+
+
 class Color:
     """Class for colors creating color objects, exposes methods for
        retrieving colors in various formats.  Take a color in hex
-       string format as its argument."""
-
-    def __init__(self, hex_color):
-        self.hex_value = str(hex_color)
-        self.rgb_value = self.rgb()
-        self.hsv_value = self.hsv()
-        self.lab_value = self.lab()
+       string format as its argument, or is a view of one color in a
+       Palette."""
+    __slots__ = ('palette', 'index')
+
+    def __init__(self, hex_color=None, colors=None, index=0):
+        if colors is None:
+            colors = Palette.from_hex([str(hex_color)])
+            index = 0
+        self.palette = colors
+        self.index = index
+
+    @property
+    def hex_value(self):
+        """color in '#rrggbb' format"""
+        return self.palette.hex[self.index]
+
+    @property
+    def rgb_value(self):
+        """color as an (r, g, b) tuple of ints"""
+        return tuple(int(x) for x in self.palette.rgb[self.index])
+
+    @property
+    def hsv_value(self):
+        """color as an (h, s, v) tuple"""
+        return tuple(float(x) for x in self.palette.hsv[self.index])
+
+    @property
+    def lab_value(self):
+        """color as an [L, a, b] list"""
+        return [float(x) for x in self.palette.lab[self.index]]
 
     def rgb(self):
         """returns color in rgb format"""
-        value = self.hex_value.lstrip('#')
-        (r, g, b) = [(value[i:i + 2]) for i in range(0, len(value), 2)]
-        (r, g, b) = [i.encode(encoding='utf_8') for i in (r, g, b)]
-        return int(r, 16), int(g, 16), int(b, 16)
+        return self.rgb_value
 
     def hsv(self):
         """returns color in hsv format"""
-        r, g, b = self.rgb()
-        r, g, b = [x/255 for x in (r, g, b)]
-        rgb_max, rgb_min = max(r, g, b), min(r, g, b)
-        diff = rgb_max - rgb_min
-        val = rgb_max * 100
-        if diff == 0:
-            hue = 0
-        else:
-            x, y, deg = r, g, 240
-            if rgb_max == r:
-                x, y, deg = g, b, 360
-            if rgb_max == g:
-                x, y, deg = b, r, 120
-            hue = (60 * ((x - y) / diff) + deg) % 360
-        sat = 0 if rgb_max == 0 else diff / rgb_max
-        return float("{:.2f}".format(hue)), float("{:.2f}".format(sat)), \
-            float("{:.2f}".format(val))
+        return self.hsv_value
 
     def lab(self):
-        r, g, b = [xx / 255 for xx in self.rgb()]
-        r, g, b = [(((xx + 0.055) / 1.055) ** 2.4) if xx > 0.04045 else xx / 12.92 for xx in (r, g, b)]
-
-        xx = (r * 0.4124 + g * 0.3576 + b * 0.1805)
-        yy = (r * 0.2126 + g * 0.7152 + b * 0.0722)
-        zz = (r * 0.0193 + g * 0.1192 + b * 0.9505)
-
-        xx = (xx / 95.047)
-        yy = (yy / 100)
-        zz = (zz / 108.883)
-
-        xx, yy, zz = [xx ** 1 / 3 if xx > 0.008856 else (7.787 * xx) + (16 / 116) for xx in (xx, yy, zz)]
+        """returns color in lab format"""
+        return self.lab_value
 
-        return [(116 * yy) - 16, 500 * (xx - yy), 200 * (yy - zz)]
+    def __repr__(self):
+        return 'Color(%r)' % self.hex_value
 
     def shade(self, amt):
         """lighten/darken a color by a positive or negative
         integer amount"""
-        r, g, b = self.rgb_value + amt
-        r, g, b = [0 if x < 0 else 255 if x > 255 else x for x in (r, g, b)]
-        r, g, b = [(''.join("{:02x}".format(x))) for x in (r, g, b)]
-        return '#%s%s%s' % (r, g, b)
+        r, g, b = [min(255, max(0, x + amt)) for x in self.rgb_value]
+        return '#%02x%02x%02x' % (r, g, b)
 
 
 def _take_out(item, item_list):
@@ -137,34 +204,35 @@ def sort_colors(color, colors):
     return _sorted
 
 
-def get(img):
-    """Use colorz to generate color objects and sort them before returning"""
-    flags = ["-n 8", "--no-preview"]
-    colors = []
-    error = None
-    if subprocess.check_output(("which", "colorz")):
-        try:
-            out = subprocess.check_output(("colorz", img, *flags)) \
-                .decode('ascii')
-            colors = []
-            for line in out.splitlines():
-                colors.append(Color(line[0:7]))
-                colors.append(Color(line[8:15]))
-        except subprocess.CalledProcessError:
-            error = True
-            logging.error("colorz returned non-zero exit status."
-                          "\n Bad image file or not enough colors?")
-            sys.exit(1)
-        finally:
-            if error:
-                sys.exit(1)
-
-    if len(colors) < 16:
-        logging.error("colorz couldn't get enough colors from the"
-                      "selected image file.")
-        sys.exit(1)
-
-    sorted_colors = colorsort.sort_colors(colors)
-    colors = [Color(color) for color in sorted_colors]
-
-    return colors
+def get_cache():
+    """the palette cache shared by every get() call in this process"""
+    global _palette_cache
+    if _palette_cache is None:
+        _palette_cache = cache.PaletteCache()
+    return _palette_cache
+
+
+def get(img, backend='kmeans', n=None, use_cache=True, **options):
+    """Extract an n color palette (extract.COLORS by default) from img
+    with the chosen backend and sort it before returning.  Palettes are
+    looked up in, and saved to, the on-disk cache unless use_cache is
+    False.  Raises extract.ExtractionError on failure"""
+    n = n or extract.COLORS
+    palette_cache = key = None
+    if use_cache:
+        with stageprof.stage('cache'):
+            palette_cache = get_cache()
+            key = palette_cache.key(img, backend=backend, n=n,
+                                    sort=colorsort.METHOD, **options)
+            sorted_colors = palette_cache.get(key)
+        if sorted_colors:
+            return Palette.from_hex(sorted_colors)
+
+    with stageprof.stage('extract'):
+        colors = Palette(extract.extract(img, n, backend, **options))
+
+    with stageprof.stage('sort'):
+        sorted_colors = colorsort.sort_colors(colors)
+    if palette_cache:
+        palette_cache.put(key, sorted_colors)
+    return Palette.from_hex(sorted_colors)
@@ -0,0 +1,143 @@
+"""
+Vectorized color space conversions.  Every function takes and returns
+numpy arrays with the channels on the last axis, so a whole palette is
+converted in one go.
+
+rgb -- uint8, 0-255 per channel
+hsv -- hue in degrees, saturation 0-1, value 0-100
+lab -- CIELab, D65 white point
+
+This is the one Lab implementation SkinIt uses.  8-bit channels are
+linearized through a 256 entry lookup table rather than a power per
+channel, and rgb_to_lab_cached() remembers the Lab values of the colors
+it has seen (keyed by packed 24-bit rgb), for the small palettes that
+get converted over and over.  The memo is shared between threads.
+"""
+import functools
+import threading
+
+from utility import lazy_import
+
+np = lazy_import('numpy')
+
+# sRGB (linear) to XYZ, D65
+RGB_TO_XYZ = (
+    (0.4124, 0.3576, 0.1805),
+    (0.2126, 0.7152, 0.0722),
+    (0.0193, 0.1192, 0.9505),
+)
+WHITE_D65 = (95.047, 100.0, 108.883)
+# colors rgb_to_lab_cached() remembers
+MEMO_SIZE = 4096
+
+_lab_memo = {}
+_memo_lock = threading.Lock()
+
+
+@functools.lru_cache(maxsize=None)
+def linear_lut():
+    """linear light for every 8-bit sRGB channel value, as a 256 entry
+    array"""
+    return _linearize(np.arange(256) / 255)
+
+
+@functools.lru_cache(maxsize=None)
+def _xyz_matrix():
+    """linear rgb to XYZ, already divided by the white point"""
+    return np.array(RGB_TO_XYZ).T * 100 / np.array(WHITE_D65)
+
+
+def _linearize(rgb):
+    """undo sRGB companding on 0-1 floats"""
+    return np.where(rgb > 0.04045, ((rgb + 0.055) / 1.055) ** 2.4,
+                    rgb / 12.92)
+
+
+def pack(rgb):
+    """(N, 3) rgb array to (N,) 24-bit integers"""
+    rgb = np.asarray(rgb, dtype=np.uint32).reshape(-1, 3)
+    return (rgb[:, 0] << 16) | (rgb[:, 1] << 8) | rgb[:, 2]
+
+
+def hex_to_rgb(hex_colors):
+    """list of '#rrggbb' strings to an (N, 3) uint8 array"""
+    packed = np.array([int(color.lstrip('#'), 16) for color in hex_colors],
+                      dtype=np.uint32).reshape(-1, 1)
+    return ((packed >> np.array([16, 8, 0], dtype=np.uint32)) & 0xff) \
+        .astype(np.uint8)
+
+
+def rgb_to_hex(rgb):
+    """(N, 3) rgb array to a list of '#rrggbb' strings"""
+    return ['#%02x%02x%02x' % tuple(color)
+            for color in np.asarray(rgb, dtype=np.uint8).tolist()]
+
+
+def rgb_to_hsv(rgb):
+    """(N, 3) rgb array to hsv, rounded to two decimals"""
+    rgb = np.asarray(rgb, dtype=np.float64) / 255
+    r, g, b = rgb[..., 0], rgb[..., 1], rgb[..., 2]
+    rgb_max, rgb_min = rgb.max(axis=-1), rgb.min(axis=-1)
+    diff = rgb_max - rgb_min
+    safe_diff = np.where(diff == 0, 1, diff)
+    hue = np.select([rgb_max == g, rgb_max == r],
+                    [60 * (b - r) / safe_diff + 120,
+                     60 * (g - b) / safe_diff + 360],
+                    60 * (r - g) / safe_diff + 240) % 360
+    hue = np.where(diff == 0, 0, hue)
+    sat = np.where(rgb_max == 0, 0, diff / np.where(rgb_max == 0, 1,
+                                                    rgb_max))
+    return np.round(np.stack([hue, sat, rgb_max * 100], axis=-1), 2)
+
+
+def rgb_to_lab(rgb):
+    """(N, 3) rgb array to CIELab"""
+    rgb = np.asarray(rgb)
+    if rgb.dtype == np.uint8:
+        linear = linear_lut()[rgb]
+    else:
+        linear = _linearize(rgb.astype(np.float64) / 255)
+    xyz = linear @ _xyz_matrix()
+    f = np.where(xyz > 0.008856, np.cbrt(xyz), 7.787 * xyz + 16 / 116)
+    return np.stack([116 * f[..., 1] - 16,
+                     500 * (f[..., 0] - f[..., 1]),
+                     200 * (f[..., 1] - f[..., 2])], axis=-1)
+
+
+def rgb_to_lab_cached(rgb):
+    """rgb_to_lab for an (N, 3) uint8 array, going through the memo.
+    Only the colors it hasn't seen before are converted"""
+    rgb = np.asarray(rgb, dtype=np.uint8).reshape(-1, 3)
+    if len(rgb) > MEMO_SIZE:
+        return rgb_to_lab(rgb)
+    keys = pack(rgb).tolist()
+    lab = np.empty((len(keys), 3))
+    missing = []
+    for i, key in enumerate(keys):
+        known = _lab_memo.get(key)
+        if known is None:
+            missing.append(i)
+        else:
+            lab[i] = known
+    if missing:
+        lab[missing] = rgb_to_lab(rgb[missing])
+        with _memo_lock:
+            for i in missing:
+                _lab_memo[keys[i]] = lab[i].copy()
+            while len(_lab_memo) > MEMO_SIZE:
+                del _lab_memo[next(iter(_lab_memo))]
+    return lab
+
+
+def lab_to_rgb(lab):
+    """(N, 3) CIELab array to rgb, clipped to the sRGB gamut"""
+    lab = np.asarray(lab, dtype=np.float64)
+    fy = (lab[..., 0] + 16) / 116
+    f = np.stack([fy + lab[..., 1] / 500, fy, fy - lab[..., 2] / 200],
+                 axis=-1)
+    xyz = np.where(f ** 3 > 0.008856, f ** 3, (f - 16 / 116) / 7.787)
+    xyz = xyz * np.array(WHITE_D65) / 100
+    linear = np.clip(xyz @ np.linalg.inv(np.array(RGB_TO_XYZ)).T, 0, 1)
+    rgb = np.where(linear > 0.0031308,
+                   1.055 * linear ** (1 / 2.4) - 0.055, linear * 12.92)
+    return np.rint(np.clip(rgb, 0, 1) * 255).astype(np.uint8)
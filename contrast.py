@@ -0,0 +1,105 @@
+"""
+Contrast enforcement.  Makes sure the colors that get drawn on the
+background (color 0) stay readable: the foregrounds (7 and 15) must
+reach TEXT_RATIO and the bright colors (9-14) ACCENT_RATIO, as WCAG
+contrast ratios.  These are terminal colors; with a palette of some
+other size they are mapped onto the palette colors the terminal
+actually gets (export.terminal_index).
+
+Colors that fall short are moved in Lab lightness only, away from the
+background, so their hue (a and b) is kept.  All of them are adjusted
+together, as one batch, by bisecting on lightness for a fixed number
+of STEPS, so the cost doesn't depend on how far off the palette is.
+A color that can't reach its target even at full lightness (or full
+darkness) ends up as close as it can get.
+"""
+import logging
+
+import colorspace
+import deltae
+from color_functions import Palette
+from export import terminal_index
+from utility import lazy_import
+
+np = lazy_import('numpy')
+
+TEXT_RATIO = 4.5
+ACCENT_RATIO = 3.0
+BACKGROUND = 0
+# (terminal color index, ratio it needs against the background)
+PAIRS = ((7, TEXT_RATIO), (15, TEXT_RATIO),
+         *((index, ACCENT_RATIO) for index in range(9, 15)))
+STEPS = 12
+# background luminance where white and black give the same contrast
+CROSSOVER = (1.05 * 0.05) ** 0.5 - 0.05
+
+
+def luminance(rgb):
+    """WCAG relative luminance of an (N, 3) uint8 rgb array"""
+    linear = colorspace.linear_lut()[np.asarray(rgb, dtype=np.uint8)]
+    return linear @ np.array([0.2126, 0.7152, 0.0722])
+
+
+def ratio(first, second):
+    """WCAG contrast ratio between two luminances (or arrays of them)"""
+    lighter = np.maximum(first, second)
+    darker = np.minimum(first, second)
+    return (lighter + 0.05) / (darker + 0.05)
+
+
+def enforce(colors, pairs=PAIRS, background=BACKGROUND, steps=STEPS):
+    """returns a copy of the palette with every pair readable"""
+    colors = Palette.from_colors(colors)
+    rgb = colors.rgb.copy()
+    index = terminal_index(len(colors))
+    background = index[background]
+    # small palettes wrap, so one color can stand for several pairs
+    targets = {}
+    for terminal, target in pairs:
+        color = int(index[terminal])
+        if color != background:
+            targets[color] = max(target, targets.get(color, 0))
+    if not targets:
+        return colors
+
+    indices = np.array(list(targets))
+    targets = np.array(list(targets.values()))
+    bg_luminance = luminance(rgb[background:background + 1])[0]
+    failing = ratio(luminance(rgb[indices]), bg_luminance) < targets
+    if not failing.any():
+        return colors
+    indices, targets = indices[failing], targets[failing]
+
+    lab = colors.lab[indices]
+
+    def candidate(lightness):
+        return colorspace.lab_to_rgb(np.column_stack([lightness,
+                                                      lab[:, 1:]]))
+
+    def enough(lightness):
+        return ratio(luminance(candidate(lightness)),
+                     bg_luminance) >= targets
+
+    # lighten on a dark background, darken on a light one, bisecting
+    # between a lightness that fails and one that passes
+    failed = lab[:, 0].copy()
+    passed = np.full(len(indices),
+                     100.0 if bg_luminance <= CROSSOVER else 0.0)
+    reachable = enough(passed)
+    for _ in range(steps):
+        middle = (failed + passed) / 2
+        ok = enough(middle)
+        passed = np.where(ok, middle, passed)
+        failed = np.where(ok, failed, middle)
+    # an unreachable target leaves passed at the extreme, the best we have
+    rgb[indices] = candidate(passed)
+    adjusted = Palette(rgb)
+    moved = deltae.ciede2000(colors.lab[indices], adjusted.lab[indices])
+    for color, distance in zip(indices, moved):
+        logging.debug("Contrast: color %s %s -> %s (delta E %.1f)", color,
+                      colors.hex[color], adjusted.hex[color], distance)
+    unreachable = indices[~reachable]
+    if len(unreachable):
+        logging.info("Colors %s can't reach their contrast target against "
+                     "the background.", ', '.join(map(str, unreachable)))
+    return adjusted
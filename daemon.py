@@ -0,0 +1,342 @@
+"""
+Watch daemon.  Keeps everything a theme change needs warm in one
+long-running process (the D-Bus proxies, numpy, the compiled templates
+and the palette cache) and re-themes when:
+
+- the Plasma wallpaper changes (the desktop's appletsrc is rewritten),
+- an image is dropped into the drop folder, or
+- a client asks it to over the UNIX socket.
+
+Files are watched with inotify, falling back to polling their mtimes
+where inotify isn't available.  Bursts of events are debounced, so one
+wallpaper change that rewrites the config several times only re-themes
+once.
+
+The socket takes one JSON request per connection, a single line such
+as {"cmd": "apply", "image": "/path/to/image", "options": {...}}, and
+answers with one JSON line.  Besides "apply" it understands "ping" and
+"stop".  Only the options in OPTIONS are taken from clients.  The client
+side is client.request().
+"""
+import ctypes
+import ctypes.util
+import json
+import logging
+import os
+import re
+import select
+import signal
+import socket
+import struct
+import time
+
+import batch
+import color_functions
+import colorsort
+import extract
+import pipeline
+import render
+import services
+from client import SOCKET_PATH, request
+from utility import create_dir
+
+DROP_DIR = os.path.join(os.environ.get('XDG_DATA_HOME') or
+                        os.path.expanduser('~/.local/share'),
+                        'skinit', 'drop')
+PLASMA_CONFIG = os.path.join(os.environ.get('XDG_CONFIG_HOME') or
+                             os.path.expanduser('~/.config'),
+                             'plasma-org.kde.plasma.desktop-appletsrc')
+DEBOUNCE = 0.3
+# pipeline.apply() options a client may set
+OPTIONS = ('splash', 'vte_fix', 'extended', 'backend', 'n', 'readable',
+           'use_cache', 'max_pixels', 'max_memory', 'set_wallpaper')
+POLL_INTERVAL = 1.0
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+EVENT_HEADER = struct.Struct('iIII')
+
+
+class InotifyWatcher:
+    """watches directories for files being written or moved in"""
+
+    def __init__(self, directories):
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self.directories = {}
+        for directory in directories:
+            wd = libc.inotify_add_watch(self.fd, directory.encode(),
+                                        IN_CLOSE_WRITE | IN_MOVED_TO)
+            if wd < 0:
+                os.close(self.fd)
+                raise OSError(ctypes.get_errno(),
+                              'inotify_add_watch failed for %s' % directory)
+            self.directories[wd] = directory
+
+    def fileno(self):
+        """file descriptor to select() on"""
+        return self.fd
+
+    def changed(self):
+        """paths of files written since the last call"""
+        paths = set()
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return paths
+        offset = 0
+        while offset < len(data):
+            wd, _, _, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = data[offset:offset + length].rstrip(b'\0').decode()
+            offset += length
+            if wd in self.directories and name:
+                paths.add(os.path.join(self.directories[wd], name))
+        return paths
+
+    def close(self):
+        """stop watching"""
+        os.close(self.fd)
+
+
+class PollingWatcher:
+    """fallback watcher that compares file mtimes every so often"""
+
+    def __init__(self, directories):
+        self.directories = list(directories)
+        self.seen = self._scan()
+
+    def _scan(self):
+        seen = {}
+        for directory in self.directories:
+            try:
+                with os.scandir(directory) as scan:
+                    for entry in scan:
+                        try:
+                            seen[entry.path] = entry.stat().st_mtime_ns
+                        except OSError:
+                            pass
+            except OSError:
+                pass
+        return seen
+
+    @staticmethod
+    def fileno():
+        """polling has nothing to select() on"""
+        return None
+
+    def changed(self):
+        """paths of files written since the last call"""
+        seen = self._scan()
+        paths = {path for path, mtime in seen.items()
+                 if self.seen.get(path) != mtime}
+        self.seen = seen
+        return paths
+
+    def close(self):
+        """stop watching"""
+
+
+def make_watcher(directories, poll=False):
+    """an inotify watcher, or a polling one if inotify isn't available"""
+    if not poll:
+        try:
+            return InotifyWatcher(directories)
+        except (OSError, AttributeError) as e:
+            logging.warning("inotify unavailable (%s), polling instead.", e)
+    return PollingWatcher(directories)
+
+
+def current_wallpaper(config=PLASMA_CONFIG):
+    """the image Plasma's desktop is currently showing, read from its
+    appletsrc, or None"""
+    try:
+        with open(config, 'r') as file:
+            text = file.read()
+    except OSError:
+        return None
+    section = None
+    for line in text.splitlines():
+        if line.startswith('['):
+            section = line
+        elif line.startswith('Image=') and section and \
+                section.endswith('[Wallpaper][org.kde.image][General]'):
+            return re.sub('^file://', '', line[len('Image='):].strip())
+    return None
+
+
+class Daemon:
+    """the long-running re-theming process"""
+
+    def __init__(self, socket_path=SOCKET_PATH, drop_dir=DROP_DIR,
+                 config=PLASMA_CONFIG, watch_config=True, poll=False,
+                 **options):
+        self.socket_path = socket_path
+        self.drop_dir = drop_dir
+        self.config = config if watch_config else None
+        self.poll = poll
+        self.options = options
+        self.last_image = None
+        self.running = False
+        self.pending = set()
+        self.last_event = 0.0
+
+    @staticmethod
+    def warm_up():
+        """pay every one-off startup cost now rather than on the first
+        theme change"""
+        try:
+            services.plasma_shell()
+            services.notifications()
+        except Exception as e:  # pylint: disable=broad-except
+            logging.warning("No D-Bus session: %s", e)
+        for template in render.templates():
+            render.compile_template(template)
+        if extract.Image is not None:
+            extract.Image.init()
+        colorsort.sort_colors(color_functions.Palette.from_hex(
+            ['#000000', '#808080', '#ffffff']))
+
+    def apply(self, img, set_wallpaper=True, **options):
+        """theme from img.  Returns the palette as hex strings"""
+        options = {**self.options, **options, 'quiet': True}
+        colors = pipeline.apply(img, set_wallpaper=set_wallpaper, **options)
+        self.last_image = img
+        return colors.hex
+
+    @staticmethod
+    def invalid(message):
+        """what is wrong with an apply request, or None"""
+        img = message.get('image')
+        if not isinstance(img, str) or not os.path.isfile(img):
+            return 'No valid image file found.'
+        options = message.get('options') or {}
+        if not isinstance(options, dict):
+            return 'Options must be an object.'
+        unknown = sorted(set(options) - set(OPTIONS))
+        if unknown:
+            return 'Unknown options: %s' % ', '.join(unknown)
+        return None
+
+    def handle(self, message):
+        """answer one socket request"""
+        command = message.get('cmd')
+        if command == 'ping':
+            return {'ok': True}
+        if command == 'stop':
+            self.running = False
+            return {'ok': True}
+        if command == 'apply':
+            error = self.invalid(message)
+            if error:
+                return {'ok': False, 'error': error}
+            try:
+                colors = self.apply(message['image'],
+                                    **message.get('options') or {})
+            except extract.ExtractionError as e:
+                return {'ok': False, 'error': str(e)}
+            return {'ok': True, 'colors': colors}
+        return {'ok': False, 'error': 'Unknown command: %s' % command}
+
+    def serve_client(self, connection):
+        """read one request from a client and answer it"""
+        with connection, connection.makefile('rwb') as stream:
+            connection.settimeout(5)
+            try:
+                message = json.loads(stream.readline() or b'{}')
+                answer = self.handle(message)
+            except ValueError as e:
+                answer = {'ok': False, 'error': 'Bad request: %s' % e}
+            except Exception as e:  # pylint: disable=broad-except
+                logging.exception("Request failed")
+                answer = {'ok': False, 'error': str(e)}
+            try:
+                stream.write(json.dumps(answer).encode() + b'\n')
+                stream.flush()
+            except OSError:
+                pass
+
+    def flush_events(self):
+        """re-theme for whatever changed during the last burst of events"""
+        changed, self.pending = self.pending, set()
+        dropped = sorted((path for path in changed
+                          if os.path.dirname(path) == self.drop_dir
+                          and path.lower().endswith(batch.IMAGE_EXTENSIONS)
+                          and os.path.isfile(path)),
+                         key=os.path.getmtime)
+        img, set_wallpaper = None, True
+        if dropped:
+            img = dropped[-1]
+        elif self.config in changed:
+            img, set_wallpaper = current_wallpaper(self.config), False
+        if not img or img == self.last_image or not os.path.isfile(img):
+            return
+        logging.info("Re-theming from %s", img)
+        try:
+            self.apply(img, set_wallpaper=set_wallpaper)
+        except extract.ExtractionError as e:
+            logging.error(e)
+
+    def _listen(self):
+        if os.path.exists(self.socket_path):
+            if request({'cmd': 'ping'}, self.socket_path, timeout=1):
+                raise RuntimeError("A SkinIt daemon is already running.")
+            os.unlink(self.socket_path)
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(self.socket_path)
+        os.chmod(self.socket_path, 0o600)
+        server.listen(8)
+        return server
+
+    def run(self):
+        """serve until stopped by a 'stop' request or a signal"""
+        create_dir(self.drop_dir)
+        directories = [self.drop_dir]
+        if self.config:
+            directories.append(os.path.dirname(self.config))
+        self.warm_up()
+        server = self._listen()
+        watcher = make_watcher(directories, self.poll)
+        signal.signal(signal.SIGTERM, lambda *_: self.stop())
+        self.running = True
+        logging.info("SkinIt daemon listening on %s", self.socket_path)
+        try:
+            while self.running:
+                self._step(server, watcher)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            watcher.close()
+            server.close()
+            if os.path.exists(self.socket_path):
+                os.unlink(self.socket_path)
+
+    def _step(self, server, watcher):
+        """one turn of the event loop"""
+        sources = [server]
+        if watcher.fileno() is not None:
+            sources.append(watcher)
+        timeout = POLL_INTERVAL  # also how often a stop() gets noticed
+        if self.pending:
+            timeout = max(0.0, self.last_event + DEBOUNCE - time.monotonic())
+        try:
+            readable, _, _ = select.select(sources, [], [], timeout)
+        except InterruptedError:
+            return
+        if server in readable:
+            connection, _ = server.accept()
+            self.serve_client(connection)
+        if watcher in readable or watcher.fileno() is None:
+            changed = watcher.changed()
+            if changed:
+                self.pending |= changed
+                self.last_event = time.monotonic()
+        if self.pending and \
+                time.monotonic() - self.last_event >= DEBOUNCE:
+            self.flush_events()
+
+    def stop(self):
+        """ask the event loop to finish"""
+        self.running = False
@@ -0,0 +1,85 @@
+"""
+Batched CIEDE2000 color difference.  Works on numpy arrays of CIELab
+colors with the channels on the last axis, so a whole palette can be
+compared against itself in a single pass instead of one colormath call
+per pair.
+"""
+from utility import lazy_import
+
+np = lazy_import('numpy')
+
+
+def _chroma_hue(lab, g):
+    """C' and h' (in degrees) of Lab colors, with a* scaled by 1 + G"""
+    a_p = (1 + g) * lab[..., 1]
+    return (np.hypot(a_p, lab[..., 2]),
+            np.degrees(np.arctan2(lab[..., 2], a_p)) % 360)
+
+
+def _hue_terms(c1p, c2p, h1p, h2p):
+    """delta H' and the mean hue h' bar.  Hue means nothing for a color
+    with no chroma, so pairs with one get no hue difference"""
+    chroma_zero = (c1p * c2p) == 0
+    dhp = h2p - h1p
+    dhp = np.where(dhp > 180, dhp - 360, dhp)
+    dhp = np.where(dhp < -180, dhp + 360, dhp)
+    dhp = np.where(chroma_zero, 0, dhp)
+    delta_hp = 2 * np.sqrt(c1p * c2p) * np.sin(np.radians(dhp) / 2)
+
+    h_sum = h1p + h2p
+    hp_bar = np.where(np.abs(h1p - h2p) > 180,
+                      np.where(h_sum < 360, h_sum + 360, h_sum - 360),
+                      h_sum) / 2
+    hp_bar = np.where(chroma_zero, h_sum, hp_bar)
+    return delta_hp, hp_bar
+
+
+def _differences(lab1, lab2):
+    """delta L', delta C' and delta H' between two arrays of Lab colors,
+    and their mean L', C' and h'"""
+    c_bar = (np.hypot(lab1[..., 1], lab1[..., 2])
+             + np.hypot(lab2[..., 1], lab2[..., 2])) / 2
+    c_bar7 = c_bar ** 7
+    g = 0.5 * (1 - np.sqrt(c_bar7 / (c_bar7 + 25.0 ** 7)))
+    c1p, h1p = _chroma_hue(lab1, g)
+    c2p, h2p = _chroma_hue(lab2, g)
+    delta_hp, hp_bar = _hue_terms(c1p, c2p, h1p, h2p)
+    return (lab2[..., 0] - lab1[..., 0], c2p - c1p, delta_hp,
+            (lab1[..., 0] + lab2[..., 0]) / 2, (c1p + c2p) / 2, hp_bar)
+
+
+def _weights(l_bar, cp_bar, hp_bar):
+    """the weighting functions S_L, S_C and S_H and the rotation term
+    R_T for colors with these means"""
+    t = (1 - 0.17 * np.cos(np.radians(hp_bar - 30))
+         + 0.24 * np.cos(np.radians(2 * hp_bar))
+         + 0.32 * np.cos(np.radians(3 * hp_bar + 6))
+         - 0.20 * np.cos(np.radians(4 * hp_bar - 63)))
+    delta_theta = 30 * np.exp(-(((hp_bar - 275) / 25) ** 2))
+    cp_bar7 = cp_bar ** 7
+    r_c = 2 * np.sqrt(cp_bar7 / (cp_bar7 + 25.0 ** 7))
+    l_term = (l_bar - 50) ** 2
+    s_l = 1 + (0.015 * l_term) / np.sqrt(20 + l_term)
+    s_c = 1 + 0.045 * cp_bar
+    s_h = 1 + 0.015 * cp_bar * t
+    r_t = -np.sin(np.radians(2 * delta_theta)) * r_c
+    return s_l, s_c, s_h, r_t
+
+
+def ciede2000(lab1, lab2):
+    """Delta E (CIE 2000) between two broadcastable arrays of Lab colors
+    shaped (..., 3).  kL, kC and kH are all taken as 1."""
+    delta_lp, delta_cp, delta_hp, l_bar, cp_bar, hp_bar = _differences(
+        np.asarray(lab1, dtype=np.float64),
+        np.asarray(lab2, dtype=np.float64))
+    s_l, s_c, s_h, r_t = _weights(l_bar, cp_bar, hp_bar)
+    delta_cp, delta_hp = delta_cp / s_c, delta_hp / s_h
+    return np.sqrt((delta_lp / s_l) ** 2 + delta_cp ** 2 + delta_hp ** 2
+                   + r_t * delta_cp * delta_hp)
+
+
+def ciede2000_matrix(labs):
+    """given an (N, 3) array of Lab colors, returns the symmetric (N, N)
+    matrix of Delta E differences between every pair of them"""
+    labs = np.asarray(labs, dtype=np.float64).reshape(-1, 3)
+    return ciede2000(labs[:, None, :], labs[None, :, :])
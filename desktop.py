@@ -0,0 +1,262 @@
+"""
+Desktop backends.  Everything SkinIt asks of the desktop (set the
+wallpaper, show a notification, apply the color scheme, reload the
+theme) goes through a backend, which queues the requests and sends
+them in as few round trips as possible when flush() is called.
+
+plasma -- talks to plasmashell and the notification service over D-Bus.
+          Color schemes are applied the way plasma-apply-colorscheme
+          does it, by setting the scheme's color keys in kdeglobals and
+          announcing the palette change.  Only those lines of the
+          user's kdeglobals are rewritten; comments, other groups and
+          formatting are left as they were.  Reloading only drops the
+          theme's own cache files and switches the desktop theme from a
+          script, instead of restarting the whole shell.
+fake   -- records what it was asked to do, optionally sleeping to stand
+          in for D-Bus latency.  For tests and benchmarks.
+"""
+import copy
+import glob
+import logging
+import os
+import threading
+import time
+
+import services
+from utility import atomic_write, open_read
+
+CACHE_HOME = os.environ.get('XDG_CACHE_HOME') or \
+    os.path.expanduser('~/.cache')
+KDEGLOBALS = os.path.join(os.environ.get('XDG_CONFIG_HOME') or
+                          os.path.expanduser('~/.config'), 'kdeglobals')
+SCHEME_DIR = os.path.join(os.environ.get('XDG_DATA_HOME') or
+                          os.path.expanduser('~/.local/share'),
+                          'color-schemes')
+# the groups of a .colors file that are copied into kdeglobals
+SCHEME_GROUPS = ('ColorEffects:', 'Colors:', 'WM')
+
+WALLPAPER_SCRIPT = """var allDesktops = desktops();for (i=0;i<allDesktops.length;i++){
+                 d = allDesktops[i];d.wallpaperPlugin = "org.kde.image";
+                 d.currentConfigGroup = Array("Wallpaper", "org.kde.image",
+                 "General");d.writeConfig("Image", "%s")};"""
+
+# re-selecting the current theme is a no-op, so hop off it and back
+THEME_SCRIPT = """if (theme == "%(theme)s") { theme = "default"; }
+                 theme = "%(theme)s";"""
+
+_backend = None
+
+
+def _entry(line):
+    """the key of a key=value line, or None for headers, comments and
+    blank lines"""
+    line = line.strip()
+    if not line or line.startswith(('#', '[')) or '=' not in line:
+        return None
+    return line.split('=', 1)[0].strip()
+
+
+def read_groups(text):
+    """the entries of a KConfig file as {group header: {key: value}}"""
+    groups, header = {}, None
+    for line in text.splitlines():
+        if line.strip().startswith('['):
+            header = line.strip()
+            groups.setdefault(header, {})
+        elif header is not None and _entry(line) is not None:
+            key, value = line.split('=', 1)
+            groups[header][key.strip()] = value.strip()
+    return groups
+
+
+def merge_groups(text, updates):
+    """KConfig text with the entries of updates ({group header: {key:
+    value}}) set.  Only the lines of those keys change; missing keys go
+    at the end of their group and missing groups at the end of the
+    file"""
+    pending = {header: dict(entries) for header, entries in updates.items()}
+    lines, group = [], None
+
+    def finish_group():
+        entries = pending.pop(group, {})
+        if entries:
+            # before the blank lines that separate it from the next group
+            end = len(lines)
+            while end and not lines[end - 1].strip():
+                end -= 1
+            lines[end:end] = ['%s=%s' % entry for entry in entries.items()]
+
+    for line in text.splitlines():
+        if line.strip().startswith('['):
+            finish_group()
+            group = line.strip()
+        elif group in pending and _entry(line) in pending[group]:
+            key = _entry(line)
+            line = '%s=%s' % (key, pending[group].pop(key))
+        lines.append(line)
+    finish_group()
+    for header, entries in pending.items():
+        if lines and lines[-1].strip():
+            lines.append('')
+        lines.append(header)
+        lines.extend('%s=%s' % entry for entry in entries.items())
+    return '\n'.join(lines) + '\n'
+
+
+class DesktopBackend:
+    """queues desktop requests until flush().  The pipeline runs stages
+    on several threads, so the queues are guarded by a lock"""
+
+    def __init__(self):
+        self.scripts = []
+        self.messages = []
+        self.schemes = []
+        self.themes = []
+        self.lock = threading.Lock()
+
+    def set_wallpaper(self, img):
+        """show img on every desktop"""
+        with self.lock:
+            self.scripts.append(WALLPAPER_SCRIPT % img)
+
+    def notify(self, summary, body=''):
+        """pop up a desktop notification"""
+        with self.lock:
+            self.messages.append((summary, body))
+
+    def apply_colorscheme(self, scheme):
+        """switch applications to color scheme (the name of a .colors
+        file in SCHEME_DIR)"""
+        with self.lock:
+            if scheme not in self.schemes:
+                self.schemes.append(scheme)
+
+    def reload_theme(self, theme):
+        """make the desktop pick up changes to theme"""
+        with self.lock:
+            if theme not in self.themes:
+                self.themes.append(theme)
+
+    def queue(self):
+        """a backend for the same desktop with a queue of its own, for
+        requests that get flushed separately"""
+        other = copy.copy(self)
+        DesktopBackend.__init__(other)
+        return other
+
+    def flush(self):
+        """send everything queued so far"""
+        raise NotImplementedError
+
+    def _take(self):
+        """hand over and clear the queues"""
+        with self.lock:
+            queued = self.scripts, self.messages, self.schemes, self.themes
+            self.scripts, self.messages = [], []
+            self.schemes, self.themes = [], []
+        return queued
+
+
+class PlasmaBackend(DesktopBackend):
+    """KDE Plasma over D-Bus"""
+
+    @staticmethod
+    def invalidate_cache(theme):
+        """delete only the cache files belonging to theme"""
+        name = theme.lower()
+        patterns = ('plasma_theme_*.kcache', 'plasma-svgelements-*')
+        for pattern in patterns:
+            for path in glob.glob(os.path.join(CACHE_HOME, pattern)):
+                if name in os.path.basename(path).lower():
+                    try:
+                        os.unlink(path)
+                    except OSError as e:
+                        logging.info("Couldn't remove %s: %s", path, e)
+
+    @staticmethod
+    def write_colorscheme(scheme, kdeglobals=KDEGLOBALS,
+                          scheme_dir=SCHEME_DIR):
+        """set the color keys of scheme in kdeglobals and make it the
+        current scheme.  Returns False if either file couldn't be
+        read"""
+        try:
+            groups = read_groups(open_read(os.path.join(scheme_dir,
+                                                        scheme + '.colors')))
+            try:
+                text = open_read(kdeglobals)
+            except FileNotFoundError:
+                text = ''
+        except (OSError, UnicodeDecodeError) as e:
+            logging.warning("Couldn't apply color scheme %s: %s", scheme, e)
+            return False
+        updates = {header: entries for header, entries in groups.items()
+                   if header[1:].startswith(SCHEME_GROUPS)}
+        updates.setdefault('[General]', {})['ColorScheme'] = scheme
+        atomic_write(merge_groups(text, updates), kdeglobals)
+        return True
+
+    def flush(self):
+        scripts, messages, schemes, themes = self._take()
+        for scheme in schemes:
+            self.write_colorscheme(scheme)
+        for theme in themes:
+            self.invalidate_cache(theme)
+            scripts.append(THEME_SCRIPT % {'theme': theme.lower()})
+        if scripts:
+            services.plasma_shell().evaluateScript('\n'.join(scripts))
+        if schemes or themes:
+            # KGlobalSettings::PaletteChanged, so apps reload their colors
+            services.emit_signal('/KGlobalSettings', 'org.kde.KGlobalSettings',
+                                 'notifyChange', '(ii)', (0, 0))
+        if messages:
+            summary = messages[0][0]
+            body = '<br>'.join(body for _, body in messages if body)
+            services.notifications().Notify('SkinIt!', 0, '', summary, body,
+                                            [], {}, 5000)
+
+
+class FakeBackend(DesktopBackend):
+    """remembers what it was asked to do instead of doing it.  latency
+    is slept once per round trip a real backend would make.  Queues
+    share the list of calls"""
+
+    def __init__(self, latency=0.0):
+        super().__init__()
+        self.latency = latency
+        self.calls = []
+
+    def flush(self):
+        scripts, messages, schemes, themes = self._take()
+        # a local file write for a real backend, not a round trip
+        if schemes:
+            self.calls.append(('applyColorScheme', schemes))
+        for theme in themes:
+            scripts.append(THEME_SCRIPT % {'theme': theme.lower()})
+        trips = [('evaluateScript', '\n'.join(scripts))] if scripts else []
+        if schemes or themes:
+            trips.append(('notifyChange', themes))
+        if messages:
+            trips.append(('Notify', messages))
+        for trip in trips:
+            time.sleep(self.latency)
+            self.calls.append(trip)
+
+
+BACKENDS = {
+    'plasma': PlasmaBackend,
+    'fake': FakeBackend,
+}
+
+
+def use(name, **options):
+    """pick the backend the rest of SkinIt will talk to"""
+    global _backend
+    _backend = BACKENDS[name](**options)
+    return _backend
+
+
+def backend():
+    """the backend in use, Plasma unless use() said otherwise"""
+    if _backend is None:
+        use('plasma')
+    return _backend
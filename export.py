@@ -3,12 +3,24 @@ This script handles all of the output, wallpaper, theme files, etc.
 """
 import glob
 import os
-import subprocess
 import logging
 
-from utility import open_write, link_file, substitute,\
-    plasma_shell, notifications, OS, disown
-from color_functions import palette, Color
+import desktop
+import xterm
+from utility import open_read, atomic_write, link_file,\
+    substitute, OS, lazy_import
+from broadcast import broadcast, OK
+from cache import OutputDigests
+from color_functions import palette, Palette
+from render import render_all
+
+np = lazy_import('numpy')
+
+TERMINAL_COLORS = 16
+
+# generated files Plasma only picks up after a theme reload
+PLASMA_PATHS = ('/desktoptheme/', '/look-and-feel/', '/color-schemes/',
+                '/plasmarc', '/kdeglobals')
 
 
 def make_theme_files(img, colors):
@@ -23,40 +35,45 @@ def make_theme_files(img, colors):
     creating their own compatible template and telling
     SkinIt where to copy it out to.
     """
-    os.chdir("templates")
-    for file in glob.glob("*.skinit"):
-        with open(file, 'r') as _input:
-            lines = _input.readlines()
-            _output = lines[0].rstrip('\n')
-            color_type = lines[1].rstrip('\n')
-            theme_data = {'[wallpaper]': img}
-        if color_type == 'hex':
-            for i, color in enumerate(colors):
-                theme_data = {**theme_data, ('[color%s]' % i):
-                              color.hex_value}
-            offset = len(lines[0]) + len(lines[1])
-            with open(file, 'r') as _input:
-                _input.seek(offset)
-                line = _input.read()
-            for key, value in theme_data.items():
-                line = line.replace(key, value)
-            open_write(line, _output)
-        elif color_type == 'rgb':
-            for i, color in enumerate(colors):
-                theme_data = {**theme_data, ('[color%s]' % i):
-                              str(color.rgb_value)}
-            offset = len(lines[0]) + len(lines[1])
-            with open(file, 'r') as _input:
-                _input.seek(offset)
-                line = _input.read()
-            for key, value in theme_data.items():
-                line = line.replace(key, value)
-            open_write(line, _output)
-    update_theme('SkinIt')
-
-
-def export_wallpaper(img, splash):
-    """change desktop and login screen wallpaper"""
+    digests = OutputDigests()
+    changed = [_output for _, _output, line in render_all(img, colors)
+               if write_if_changed(line, _output, digests)]
+    digests.save()
+    for _output in changed:
+        if '/color-schemes/' in _output and _output.endswith('.colors'):
+            desktop.backend().apply_colorscheme(
+                os.path.basename(_output)[:-len('.colors')])
+    if any(plasma_output(_output) for _output in changed):
+        update_theme('SkinIt')
+    return changed
+
+
+def write_if_changed(data, _output, digests):
+    """atomically write data to _output, unless it already holds exactly
+    that.  Returns True if the file was written"""
+    digest = digests.digest(data)
+    if digests.unchanged(_output, digest):
+        return False
+    try:
+        if open_read(_output) == data:
+            digests.record(_output, digest)
+            return False
+    except (OSError, UnicodeDecodeError):
+        pass
+    atomic_write(data, _output)
+    digests.record(_output, digest)
+    return True
+
+
+def plasma_output(_output):
+    """True if Plasma needs reloading to pick up a change to _output"""
+    _output = os.path.abspath(_output)
+    return any(part in _output for part in PLASMA_PATHS)
+
+
+def export_wallpaper(img, splash, backend=None):
+    """change desktop and login screen wallpaper, queued on backend
+    (desktop.backend() by default)"""
     if splash:
         file_name = str(os.path.split(img))
 
@@ -70,14 +87,9 @@ def export_wallpaper(img, splash):
         substitute(splash_temp, splash_qml, **data)
 
     else:
-        string = """var allDesktops = desktops();for (i=0;i<allDesktops.length;i++){
-                 d = allDesktops[i];d.wallpaperPlugin = "org.kde.image";
-                 d.currentConfigGroup = Array("Wallpaper", "org.kde.image",
-                 "General");d.writeConfig("Image", "%s")};"""
-
-        plasma_shell.evaluateScript(string % img)
-        notifications.Notify('SkinIt!', 0, '', 'Wallpaper updated!',
-                             ('<i>%s</i>' % img), [], {}, 5000)
+        backend = backend or desktop.backend()
+        backend.set_wallpaper(img)
+        backend.notify('Wallpaper updated!', '<i>%s</i>' % img)
 
 
 def set_special(index, color, iterm_name="h", alpha=100):
@@ -98,28 +110,57 @@ def set_color(index, color):
 
 def set_iterm_tab_color(color):
     """Set iTerm2 tab/window color"""
-    rgb_color = Color(color)
     return ("\033]6;1;bg;red;brightness;%s\a"
             "\033]6;1;bg;green;brightness;%s\a"
-            "\033]6;1;bg;blue;brightness;%s\a") % rgb_color.rgb()
-
-
-def create_sequences(colors, vte_fix=False):
-    """Create the escape sequences."""
+            "\033]6;1;bg;blue;brightness;%s\a") % color.rgb_value
+
+
+def terminal_index(size):
+    """which palette color each of the 16 terminal colors takes, for a
+    palette of size colors.  Small palettes wrap around (with 8 colors,
+    the bright ones repeat the normal ones); bigger ones are sampled
+    evenly along their sorted order, keeping the first (background)
+    color"""
+    if size <= TERMINAL_COLORS:
+        return np.arange(TERMINAL_COLORS) % size
+    return np.rint(np.linspace(0, size - 1,
+                               TERMINAL_COLORS)).astype(np.intp)
+
+
+def terminal_colors(colors):
+    """the 16 colors a terminal gets from a palette of any size, see
+    terminal_index()"""
+    colors = Palette.from_colors(colors)
+    if len(colors) == TERMINAL_COLORS:
+        return colors
+    return Palette(colors.rgb[terminal_index(len(colors))])
+
+
+def create_sequences(colors, vte_fix=False, extended=False):
+    """Create the escape sequences.  With extended, also remap xterm
+    colors 16-255 onto the theme."""
+    colors = terminal_colors(colors)
+    hex_colors = colors.hex
     # Colors 0-15.
-    sequences = [set_color(index, colors[index]) for index in range(16)]
+    sequences = [set_color(index, color) for index, color
+                 in enumerate(colors)]
+
+    # Colors 16-255.
+    if extended:
+        sequences.extend(set_color(index, color) for index, color
+                         in enumerate(xterm.extended_colors(colors), 16))
 
     # Special colors.
     # Source: https://goo.gl/KcoQgP
     # 10 = foreground, 11 = background, 12 = cursor foregound
     # 13 = mouse foreground, 708 = background border color.
     sequences.extend([
-        set_special(10, colors[7], "g"),
-        set_special(11, colors[0], "h"),
-        set_special(12, colors[7], "l"),
-        set_special(13, colors[7], "j"),
-        set_special(17, colors[7], "k"),
-        set_special(19, colors[0], "m"),
+        set_special(10, hex_colors[7], "g"),
+        set_special(11, hex_colors[0], "h"),
+        set_special(12, hex_colors[7], "l"),
+        set_special(13, hex_colors[7], "j"),
+        set_special(17, hex_colors[7], "k"),
+        set_special(19, hex_colors[0], "m"),
         set_color(232, colors[0]),
         set_color(256, colors[7]),
         set_color(257, colors[0]),
@@ -127,44 +168,37 @@ def create_sequences(colors, vte_fix=False):
 
     if not vte_fix:
         sequences.extend(
-            set_special(708, colors[0], "")
+            set_special(708, hex_colors[0], "")
         )
     if OS == "Darwin":
         sequences += set_iterm_tab_color(colors[0])
     return "".join(sequences)
 
 
-def send(colors, to_send=True, vte_fix=False, quiet=False):
-    """Send colors to all open terminals."""
+def send(colors, to_send=True, vte_fix=False, quiet=False, timeout=0.5,
+         extended=False):
+    """Send colors to all open terminals.  Returns a dict of
+    terminal => broadcast status"""
     if not quiet:
         palette()
+        if len(colors) != TERMINAL_COLORS:
+            palette(colors)
+    results = {}
     # Writing to "/dev/pts/[0-9] lets you send data to open terminals.
     if to_send:
         tty_pattern = "/dev/ttys00[0-9]*" if OS == "Darwin" else "/dev/pts/[0-9]*"
-        sequences = create_sequences(colors, vte_fix)
-        for term in glob.glob(tty_pattern):
-            open_write(sequences, term)
+        sequences = create_sequences(colors, vte_fix, extended)
+        results = broadcast(sequences, glob.glob(tty_pattern), timeout)
+        for term, status in results.items():
+            if status != OK:
+                logging.warning("Couldn't update %s: %s", term, status)
+    return results
 
 
 def update_theme(theme):
-    """reload the plasma theme - from cli lookandfeeltool &
-    lookandfeeltool --platformtheme  also .config/plasmarc
-    rm .cache/plasma* -R to clear plasma cache and
-    plasmashell --replace
-    store in /.local/share/plasma/desktoptheme/
-    TODO: loadlookandfeel resets our wallpaper!!  figure that out"""
-    home = os.environ['HOME']
-
-    try:
-        disown('rm %s/.cache/plasma* -R' % home)
-    except subprocess.CalledProcessError as e:
-        if 'FileNotFoundError' in e.output:
-            logging.info('Nothing to delete in Plasma cache... bypassing')
-    finally:
-        try:
-            disown('plasmashell --replace')
-        except subprocess.CalledProcessError as e:
-            if 'FileNotFoundError' in e.output:
-                logging.info('No plasma shell to restart, do you have Plasma installed?')
-        finally:
-            return()
+    """reload the plasma theme.  Only the theme's own cache is dropped
+    and the desktop is told to switch to it again, rather than clearing
+    all of .cache/plasma* and restarting plasmashell.  Queued on the
+    desktop backend; sent with the next flush()
+    store in /.local/share/plasma/desktoptheme/"""
+    desktop.backend().reload_theme(theme)
@@ -0,0 +1,229 @@
+"""
+Palette extraction backends.  Each backend takes the path to an image
+and the number of colors wanted, and returns the colors as an (n, 3)
+array of 0-255 rgb values; color_functions.get() makes a Palette of
+them.
+
+kmeans -- in-process: decodes the image at reduced size, downsamples it
+          to a pixel budget and runs a vectorized mini-batch k-means
+          over it.
+histogram -- in-process: bins a larger sample of the image into a 3D
+          color histogram (across processes for very large samples) and
+          reduces it by median cut.  Histograms are cached, see histogram.py.
+colorz -- runs the external colorz tool, kept as a fallback for systems
+          without numpy or Pillow.
+
+Backends raise ExtractionError instead of exiting, so they are safe to
+call from other code.
+"""
+import logging
+
+from utility import lazy_import
+
+colorspace = lazy_import('colorspace')
+histogram = lazy_import('histogram')
+np = lazy_import('numpy')
+shutil = lazy_import('shutil')
+subprocess = lazy_import('subprocess')
+Image = lazy_import('PIL.Image')
+
+# palette sizes
+COLORS = 16
+MIN_COLORS = 8
+MAX_COLORS = 256
+MAX_PIXELS = 256 * 256
+# the histogram backend's pixel budget; binning is cheap, so it can
+# afford to look at far more of the image
+HISTOGRAM_PIXELS = 4096 * 1024
+# most memory decoding an image may take, in bytes
+MAX_MEMORY = 256 * 1024 * 1024
+# modes Image.reduce() works on directly
+REDUCIBLE_MODES = ('L', 'LA', 'RGB', 'RGBA', 'RGBX', 'CMYK')
+
+
+class ExtractionError(Exception):
+    """Raised when a palette can't be extracted from an image."""
+
+
+def load_pixels(img, max_pixels=MAX_PIXELS, max_memory=MAX_MEMORY):
+    """decode an image and return its pixels as an (N, 3) float32 array,
+    downsampled so that N is no larger than max_pixels.
+
+    JPEGs are decoded straight to a reduced size (DCT scaling).  Other
+    formats are decoded once at full size and box-reduced by a whole
+    factor, which only allocates the small result, before any
+    conversion.  They are not decoded in tiles or strides: PNG, WebP and
+    the rest are compressed as a single stream, which Pillow only
+    decodes whole.  So max_memory bytes (None for no limit) is a cap,
+    not a sampling budget; an image that would take more than that to
+    decode is refused with an ExtractionError rather than sampled"""
+    try:
+        with Image.open(img) as image:
+            # let the decoder skip detail we don't need (JPEG DCT scaling)
+            image.draft('RGB', _fit(image.size, max_pixels))
+            cost = decode_cost(image)
+            if max_memory and cost > max_memory:
+                raise ExtractionError(
+                    "Decoding %s would take %s MiB, more than the %s MiB "
+                    "allowed." % (img, cost >> 20, max_memory >> 20))
+            if image.mode not in REDUCIBLE_MODES:
+                image = image.convert('RGB')
+            factor = int((image.width * image.height / max_pixels) ** 0.5)
+            if factor > 1:
+                image = image.reduce(factor)
+            image = image.convert('RGB')
+            if image.width * image.height > max_pixels:
+                image.thumbnail(_fit(image.size, max_pixels),
+                                Image.Resampling.BILINEAR)
+            pixels = np.asarray(image, dtype=np.float32)
+    except OSError as e:
+        raise ExtractionError("Couldn't read image file: %s" % e) from e
+    return pixels.reshape(-1, 3)
+
+
+def decode_cost(image):
+    """bytes needed to decode an opened image at its (drafted) size,
+    plus a full-size RGB copy if its mode can't be reduced as is"""
+    pixels = image.width * image.height
+    if image.mode in ('1', 'L', 'P'):
+        cost = pixels
+    elif image.mode.startswith('I;16'):
+        cost = 2 * pixels
+    else:
+        cost = 4 * pixels  # Pillow keeps multi-band pixels in 32 bits
+    if image.mode not in REDUCIBLE_MODES:
+        cost += 4 * pixels
+    return cost
+
+
+def _fit(size, max_pixels):
+    """scale a (width, height) pair down to fit within max_pixels"""
+    width, height = size
+    scale = min(1.0, (max_pixels / float(width * height)) ** 0.5)
+    return max(1, int(width * scale)), max(1, int(height * scale))
+
+
+def _sq_distances(points, centers):
+    """squared euclidean distance from every point to every center"""
+    return (np.einsum('ij,ij->i', points, points)[:, None]
+            - 2 * points @ centers.T
+            + np.einsum('ij,ij->i', centers, centers)[None, :])
+
+
+def _init_centers(points, n, rng):
+    """k-means++ seeding"""
+    centers = np.empty((n, 3), dtype=np.float32)
+    centers[0] = points[rng.integers(len(points))]
+    closest = _sq_distances(points, centers[:1])[:, 0]
+    for i in range(1, n):
+        total = closest.sum()
+        if total <= 0:
+            centers[i:] = centers[0]
+            break
+        pick = rng.choice(len(points), p=closest / total)
+        centers[i] = points[pick]
+        closest = np.minimum(closest,
+                             _sq_distances(points, centers[i:i + 1])[:, 0])
+    return centers
+
+
+def kmeans(pixels, n, batch_size=1024, iterations=100, seed=0):
+    """mini-batch k-means over an (N, 3) pixel array.  Returns the n
+    cluster centers as an (n, 3) array, most populous cluster first"""
+    packed = pixels.astype(np.uint32) @ np.array([65536, 256, 1], np.uint32)
+    if len(np.unique(packed)) < n:
+        raise ExtractionError("Not enough distinct colors in the image.")
+
+    rng = np.random.default_rng(seed)
+    seed_sample = pixels[rng.integers(len(pixels), size=16 * batch_size)]
+    centers = _init_centers(seed_sample, n, rng)
+    counts = np.zeros(n)
+    batch_size = min(batch_size, len(pixels))
+
+    for _ in range(iterations):
+        batch = pixels[rng.integers(len(pixels), size=batch_size)]
+        labels = _sq_distances(batch, centers).argmin(axis=1)
+        batch_counts = np.bincount(labels, minlength=n)
+        sums = np.stack([np.bincount(labels, batch[:, channel], n)
+                         for channel in range(3)], axis=1)
+        hit = batch_counts > 0
+        counts[hit] += batch_counts[hit]
+        # per-center learning rate of batch_count / total_count
+        rate = (batch_counts[hit] / counts[hit])[:, None]
+        centers[hit] += rate * (sums[hit] / batch_counts[hit][:, None]
+                                - centers[hit])
+
+    # one full pass to rank clusters by size and re-seed any empty ones
+    distances = _sq_distances(pixels, centers)
+    labels = distances.argmin(axis=1)
+    sizes = np.bincount(labels, minlength=n)
+    for i in np.flatnonzero(sizes == 0):
+        centers[i] = pixels[distances.min(axis=1).argmax()]
+        distances[:, i] = _sq_distances(pixels, centers[i:i + 1])[:, 0]
+    return centers[np.argsort(-sizes, kind='stable')]
+
+
+def from_kmeans(img, n, max_pixels=MAX_PIXELS, max_memory=MAX_MEMORY):
+    """in-process backend: k-means over a downsampled copy of img"""
+    centers = kmeans(load_pixels(img, max_pixels, max_memory), n)
+    return np.clip(np.rint(centers), 0, 255)
+
+
+def from_histogram(img, n, max_pixels=HISTOGRAM_PIXELS,
+                   max_memory=MAX_MEMORY, jobs=None):
+    """in-process backend: median cut over a color histogram"""
+    colors = histogram.image_histogram(img, load_pixels,
+                                       (max_pixels, max_memory),
+                                       jobs=jobs).palette(n)
+    return np.clip(np.rint(colors), 0, 255)
+
+
+def from_colorz(img, n, **_):
+    """external backend: parse the output of colorz.  colorz prints two
+    columns per line (a color and a brightened version of it)"""
+    if not shutil.which('colorz'):
+        raise ExtractionError("colorz is not installed.")
+    flags = ["-n %s" % ((n + 1) // 2), "--no-preview"]
+    try:
+        out = subprocess.check_output(("colorz", img, *flags)) \
+            .decode('ascii')
+    except subprocess.CalledProcessError as e:
+        raise ExtractionError("colorz returned non-zero exit status."
+                              "\n Bad image file or not enough colors?") \
+            from e
+    colors = []
+    for line in out.splitlines():
+        colors.append(line[0:7])
+        colors.append(line[8:15])
+    return colorspace.hex_to_rgb(colors[:n])
+
+
+BACKENDS = {
+    'kmeans': from_kmeans,
+    'histogram': from_histogram,
+    'colorz': from_colorz,
+}
+
+
+def extract(img, n=COLORS, backend='kmeans', **options):
+    """extract n colors from img with the named backend, as an (n, 3)
+    rgb array.  Falls back to colorz if the in-process backend's
+    dependencies are missing"""
+    if backend not in BACKENDS:
+        raise ExtractionError("Unknown extraction backend: %s" % backend)
+    if not MIN_COLORS <= n <= MAX_COLORS:
+        raise ExtractionError("Palettes can have %s to %s colors, not %s."
+                              % (MIN_COLORS, MAX_COLORS, n))
+    if backend != 'colorz' and (np is None or Image is None):
+        logging.warning("numpy and Pillow are required for the %s backend,"
+                        " falling back to colorz.", backend)
+        backend = 'colorz'
+
+    # unset options mean the backend's own defaults
+    options = {key: value for key, value in options.items()
+               if value is not None}
+    colors = BACKENDS[backend](img, n, **options)
+    if len(colors) < n:
+        raise ExtractionError("Couldn't get enough colors from the "
+                              "selected image file.")
+    return colors
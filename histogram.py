@@ -0,0 +1,219 @@
+"""
+Color histograms for the histogram extraction backend.  The decoded
+image is binned into a 3D histogram (BITS bits per channel).  Every bin
+keeps a pixel count and the channel sums of its pixels, so histograms
+merge by plain addition and each bin knows its mean color, not just its
+center.
+
+np.bincount holds the GIL, so threads can't share the binning.  Samples
+of PARALLEL_PIXELS or more, which the default pixel budget gives for
+any image of a megapixel or more, are instead split into slices binned
+by a process pool, the workers reading the pixels from shared memory
+rather than having them pickled over.  Smaller ones are binned in a single
+pass.  The pool's workers come from a forkserver, since the pipeline
+calls this from worker threads and forking a threaded process isn't
+safe.
+
+Histograms save to and load from .npz files.  Those built from images
+are kept in $XDG_CACHE_HOME/skinit/histograms, keyed by the image's
+contents and the loading parameters, so asking for a different number
+of colors from the same image skips decoding altogether.
+
+The palette is derived by median cut over the occupied bins: the box
+with the most pixels times the widest channel range is split at the
+pixel-weighted median of that channel until there are n boxes.
+"""
+import hashlib
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import cache
+from utility import create_dir, lazy_import
+
+np = lazy_import('numpy')
+
+BITS = 5
+# one pass bins about 40 million pixels a second, so below this a
+# slice is only a few milliseconds of work and starting workers costs
+# more than it saves
+PARALLEL_PIXELS = 1 << 20
+CACHE_DIR = os.path.join(cache.CACHE_DIR, 'histograms')
+MAX_ENTRIES = 256
+
+
+class Histogram:
+    """pixel counts and channel sums for each of the 2**(3 * bits) bins"""
+
+    def __init__(self, counts, sums, bits=BITS):
+        self.bits = bits
+        self.counts = np.asarray(counts, dtype=np.int64)
+        self.sums = np.asarray(sums, dtype=np.float64).reshape(-1, 3)
+
+    @classmethod
+    def empty(cls, bits=BITS):
+        """a histogram with nothing in it"""
+        size = 1 << (3 * bits)
+        return cls(np.zeros(size), np.zeros((size, 3)), bits)
+
+    @classmethod
+    def from_pixels(cls, pixels, bits=BITS):
+        """bin an (N, 3) array of 0-255 pixels"""
+        # one contiguous row per channel, so no pass strides over pixels
+        channels = np.ascontiguousarray(
+            np.asarray(pixels, dtype=np.uint8).reshape(-1, 3).T)
+        size = 1 << (3 * bits)
+        quantized = channels >> (8 - bits)
+        index = quantized[0].astype(np.intp)
+        for channel in quantized[1:]:
+            index <<= bits
+            index |= channel
+        counts = np.bincount(index, minlength=size)
+        sums = np.stack([np.bincount(index, channel, size)
+                         for channel in channels], axis=1)
+        return cls(counts, sums, bits)
+
+    @classmethod
+    def from_slices(cls, pixels, bits=BITS, jobs=None,
+                    parallel_pixels=PARALLEL_PIXELS):
+        """bin pixels on a process pool, one slice per worker, when
+        there are enough of them to be worth it; otherwise in one
+        pass"""
+        pixels = np.asarray(pixels, dtype=np.uint8).reshape(-1, 3)
+        jobs = jobs or os.cpu_count() or 1
+        if jobs < 2 or len(pixels) < parallel_pixels:
+            return cls.from_pixels(pixels, bits)
+        shared = shared_memory.SharedMemory(create=True, size=pixels.nbytes)
+        try:
+            view = np.ndarray(pixels.shape, np.uint8, shared.buf)
+            view[:] = pixels
+            del view
+            bounds = np.linspace(0, len(pixels), jobs + 1).astype(int)
+            with ProcessPoolExecutor(max_workers=jobs,
+                                     mp_context=_pool_context()) as pool:
+                parts = pool.map(_bin_shared, [shared.name] * jobs,
+                                 [pixels.shape] * jobs, bounds[:-1],
+                                 bounds[1:], [bits] * jobs)
+                return merge((cls(counts, sums, bits)
+                              for counts, sums in parts), bits)
+        finally:
+            shared.close()
+            shared.unlink()
+
+    def __add__(self, other):
+        if self.bits != other.bits:
+            raise ValueError("Can't merge %s and %s bit histograms."
+                             % (self.bits, other.bits))
+        return Histogram(self.counts + other.counts, self.sums + other.sums,
+                         self.bits)
+
+    def __len__(self):
+        """number of occupied bins"""
+        return int(np.count_nonzero(self.counts))
+
+    def save(self, path):
+        """write to an .npz file, atomically"""
+        # np.savez_compressed adds .npz to names that don't end in it
+        stem = path[:-len('.npz')] if path.endswith('.npz') else path
+        tmp = '%s.%s.tmp.npz' % (stem, os.getpid())
+        np.savez_compressed(tmp, counts=self.counts, sums=self.sums,
+                            bits=self.bits)
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path):
+        """read a histogram written by save()"""
+        with np.load(path) as data:
+            return cls(data['counts'], data['sums'], int(data['bits']))
+
+    def palette(self, n):
+        """up to n colors by median cut, most populous first, as an
+        (n, 3) float array"""
+        occupied = np.flatnonzero(self.counts)
+        weights = self.counts[occupied].astype(np.float64)
+        colors = self.sums[occupied] / weights[:, None]
+        boxes = [_box(colors, weights, np.arange(len(occupied)))]
+        while len(boxes) < n:
+            best = max(range(len(boxes)), key=lambda i: boxes[i][0])
+            score, members, axis = boxes[best]
+            if score <= 0:
+                break
+            del boxes[best]
+            ordered = members[np.argsort(colors[members, axis],
+                                         kind='stable')]
+            total = np.cumsum(weights[ordered])
+            cut = int(np.searchsorted(total, total[-1] / 2)) + 1
+            cut = min(max(cut, 1), len(ordered) - 1)
+            boxes.append(_box(colors, weights, ordered[:cut]))
+            boxes.append(_box(colors, weights, ordered[cut:]))
+        means = np.array([np.average(colors[members], axis=0,
+                                     weights=weights[members])
+                          for _, members, _ in boxes])
+        sizes = np.array([weights[members].sum()
+                          for _, members, _ in boxes])
+        return means[np.argsort(-sizes, kind='stable')]
+
+
+def _box(colors, weights, members):
+    """(split priority, members, widest axis) for a median cut box"""
+    if len(members) < 2:
+        return 0.0, members, 0
+    span = colors[members].max(axis=0) - colors[members].min(axis=0)
+    axis = int(span.argmax())
+    return float(span[axis] * weights[members].sum()), members, axis
+
+
+def _pool_context():
+    """forkserver workers, forked with numpy and this module already
+    imported so each slice doesn't pay for the imports"""
+    context = multiprocessing.get_context('forkserver')
+    context.set_forkserver_preload(['numpy', __name__])
+    return context
+
+
+def _bin_shared(name, shape, start, end, bits):
+    """worker: (counts, sums) of rows start to end of the pixels in the
+    shared memory block name"""
+    shared = shared_memory.SharedMemory(name=name)
+    pixels = np.ndarray(shape, np.uint8, shared.buf)
+    part = Histogram.from_pixels(pixels[start:end], bits)
+    # the block can't be closed while an array still points into it
+    del pixels
+    shared.close()
+    return part.counts, part.sums
+
+
+def merge(histograms, bits=BITS):
+    """sum any number of histograms"""
+    total = Histogram.empty(bits)
+    for histogram in histograms:
+        total = total + histogram
+    return total
+
+
+def image_histogram(img, load, params, *, bits=BITS, jobs=None,
+                    cache_dir=CACHE_DIR):
+    """histogram of img, from the histogram cache when possible.
+    Otherwise load(img, *params) decodes it to an (N, 3) pixel array
+    (extract.load_pixels does).  params are part of the cache key"""
+    # so is a memory cap, as it decides whether img loads at all
+    key = hashlib.blake2b(('%s-%s-%s' % (
+        cache.image_hash(img), '-'.join(str(param) for param in params),
+        bits)).encode(), digest_size=16).hexdigest()
+    path = os.path.join(cache_dir, key + '.npz')
+    try:
+        histogram = Histogram.load(path)
+        os.utime(path)
+        return histogram
+    except (OSError, ValueError, KeyError):
+        pass
+    pixels = load(img, *params)
+    histogram = Histogram.from_slices(pixels, bits, jobs=jobs)
+    try:
+        create_dir(cache_dir)
+        histogram.save(path)
+        cache.evict(cache_dir, MAX_ENTRIES, '.npz')
+    except OSError:
+        pass
+    return histogram
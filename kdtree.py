@@ -2,65 +2,57 @@
 # encoding: utf-8
 """ KDTree implementation.
 Features:
-- nearest neighbours search
+- nearest neighbours search, one point or a batch of points at a time
+- radius search
+- saving a built tree to an .npz file and loading it back
+The tree is stored flat, in numpy arrays: the points are reordered so
+every node covers a contiguous slice of them, and each node is split at
+the median of its widest axis with argpartition.  Searches walk the
+tree with an explicit stack and keep the best k points in a bounded
+max-heap.
 Matej Drame [matej.drame@gmail.com]
 """
 __version__ = "1r11.1.2010"
 __all__ = ["KDTree"]
 
-from dataclasses import dataclass
+import heapq
+import os
 
+from utility import lazy_import
 
-def square_distance(point_a, point_b):
-    """ squared euclidean distance """
-    dimensions = len(point_a)  # assumes both points have the same dimensions
-    return sum(
-        (point_a[dimension] - point_b[dimension]) ** 2
-        for dimension in range(dimensions)
-    )
+np = lazy_import('numpy')
 
-
-@dataclass
-class KDTreeNode:
-    """this is a class, plylint"""
-    point = tuple
-    left = tuple
-    right = tuple
+LEAF_SIZE = 8
+# the arrays a built tree is made of, as written by save()
+ARRAYS = ('data', 'order', 'start', 'end', 'axis', 'split', 'left', 'right')
+# query_batch compares against every point for trees this small
+BRUTE_FORCE_SIZE = 256
 
 
 class KDTreeNeighbours:
-    """ Internal structure used in nearest-neighbours search.  """
-    def __init__(self, query_point, neighbors):
-        self.query_point = query_point
+    """ Internal structure used in nearest-neighbours search: a max-heap
+    holding the best `neighbors` points seen so far.  """
+    def __init__(self, neighbors):
         self.neighbors = neighbors  # neighbours wanted
-        self.largest_distance = 0  # squared
-        self.current_best = []
-
-    def calculate_largest(self):
-        """ looks like a fancy way to do max()"""
-        if self.neighbors >= len(self.current_best):
-            self.largest_distance = self.current_best[-1][1]
-        else:
-            self.largest_distance = self.current_best[self.neighbors - 1][1]
-
-    def add(self, point):
-        """ run through current_best, try to find appropriate place """
-        s_d = square_distance(point, self.query_point)
-
-        for i, best in enumerate(self.current_best):
-            if i == self.neighbors:
-                return
-            if best[1] > s_d:
-                self.current_best.insert(i, [point, s_d])
-                self.calculate_largest()
-                return
-        # append it to the end otherwise
-        self.current_best.append([point, s_d])
-        self.calculate_largest()
+        self.heap = []  # (-squared distance, index)
+
+    @property
+    def largest_distance(self):
+        """ squared distance to the worst point we'd still keep """
+        if len(self.heap) < self.neighbors:
+            return float('inf')
+        return -self.heap[0][0]
+
+    def add(self, s_d, index):
+        """ offer a point at squared distance s_d """
+        if len(self.heap) < self.neighbors:
+            heapq.heappush(self.heap, (-s_d, index))
+        elif s_d < -self.heap[0][0]:
+            heapq.heapreplace(self.heap, (-s_d, index))
 
     def get_best(self):
-        """here we're reinventing the wheel again i think"""
-        return [element[0] for element in self.current_best[:self.neighbors]]
+        """ (squared distance, index) pairs, nearest first """
+        return sorted((-s_d, index) for s_d, index in self.heap)
 
 
 class KDTree:
@@ -70,70 +62,186 @@ class KDTree:
             data = <load data> # iterable of points (which are also iterable,
             same length) point = <the point of which neighbours we're looking
             for> tree = KDTree.construct_from_data(data)
-            nearest = tree.query(point, t=4) # find nearest 4 points
+            nearest = tree.query(point, neighbors=4) # find nearest 4 points
+            distances, indices = tree.query_batch(points, k=4)
     """
-    def __init__(self, data):
-        """ yup, it's an init function alright."""
-        def build_kdtree(point_list, depth):
-            """ let's build a tree!"""
-            if not point_list:
-                return None
-            axis = depth % len(point_list[0])
-            # sort point list and choose median as pivot point,
-            point_list.sort(key=lambda point: point[axis])
-            median = int(round(len(point_list)/2))  # choose median
-            # create node and recursively construct subtrees
-            node = KDTreeNode()
-            node.point = point_list[median]
-            node.left = build_kdtree(point_list[0:median], depth+1)
-            node.right = build_kdtree(point_list[median+1:], depth+1)
-            return node
-        self.root_node = build_kdtree(data, depth=0)
+    def __init__(self, data, leaf_size=LEAF_SIZE):
+        """ build the tree without recursion: every node is a slice
+        [start, end) of self.order, split at the median of its widest
+        axis until slices are no bigger than leaf_size """
+        self.data = np.asarray(data, dtype=np.float64)
+        if self.data.ndim == 1:
+            self.data = self.data.reshape(len(self.data), -1)
+        size = len(self.data)
+        order = np.arange(size)
+        start, end, axis, split, left, right = [], [], [], [], [], []
+
+        def new_node(node_start, node_end):
+            start.append(node_start)
+            end.append(node_end)
+            axis.append(-1)
+            split.append(0.0)
+            left.append(-1)
+            right.append(-1)
+            return len(start) - 1
+
+        if size:
+            stack = [new_node(0, size)]
+            while stack:
+                node = stack.pop()
+                node_start, node_end = start[node], end[node]
+                if node_end - node_start <= leaf_size:
+                    continue
+                points = self.data[order[node_start:node_end]]
+                widest = int((points.max(axis=0) - points.min(axis=0))
+                             .argmax())
+                median = (node_end - node_start) // 2
+                part = np.argpartition(points[:, widest], median)
+                order[node_start:node_end] = order[node_start:node_end][part]
+                axis[node] = widest
+                split[node] = float(self.data[order[node_start + median],
+                                              widest])
+                left[node] = new_node(node_start, node_start + median)
+                right[node] = new_node(node_start + median, node_end)
+                stack.extend((left[node], right[node]))
+
+        self.order = order
+        self.points = self.data[order]  # leaves are contiguous slices
+        self.start = np.array(start, dtype=np.intp)
+        self.end = np.array(end, dtype=np.intp)
+        self.axis = np.array(axis, dtype=np.intp)
+        self.split = np.array(split)
+        self.left = np.array(left, dtype=np.intp)
+        self.right = np.array(right, dtype=np.intp)
+        self._walk()
+
+    def _walk(self):
+        """ plain lists walk faster than numpy scalars in the search
+        loop """
+        self._nodes = list(zip(self.start.tolist(), self.end.tolist(),
+                               self.axis.tolist(), self.split.tolist(),
+                               self.left.tolist(), self.right.tolist()))
 
     @staticmethod
     def construct_from_data(data):
-        """ let's build a differnt kind of tree! """
+        """ build a tree from an iterable of points """
         return KDTree(data)
 
+    def save(self, path):
+        """ write the built tree to an .npz file, atomically """
+        # np.savez adds .npz to names that don't end in it
+        stem = path[:-len('.npz')] if path.endswith('.npz') else path
+        tmp = '%s.%s.tmp.npz' % (stem, os.getpid())
+        np.savez(tmp, **{name: getattr(self, name) for name in ARRAYS})
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path):
+        """ read a tree written by save(), without building it again """
+        tree = cls.__new__(cls)
+        with np.load(path) as arrays:
+            for name in ARRAYS:
+                setattr(tree, name, arrays[name])
+        tree.points = tree.data[tree.order]
+        tree._walk()
+        return tree
+
+    def __len__(self):
+        return len(self.data)
+
+    def _search(self, point, neighbours):
+        """ depth first search for the points nearest to point, nearer
+        side of each split first, skipping any subtree that can't beat
+        the current worst neighbour """
+        coords = point.tolist()
+        stack = [(0, 0.0)]  # (node, lower bound on squared distance)
+        while stack:
+            node, bound = stack.pop()
+            if bound > neighbours.largest_distance:
+                continue
+            node_start, node_end, axis, split, left, right = \
+                self._nodes[node]
+            if left < 0:
+                s_d = ((self.points[node_start:node_end] - point) ** 2) \
+                    .sum(axis=1)
+                for offset in np.argsort(s_d)[:neighbours.neighbors]:
+                    neighbours.add(float(s_d[offset]),
+                                   int(self.order[node_start + offset]))
+                continue
+            diff = coords[axis] - split
+            near, far = (left, right) if diff < 0 else (right, left)
+            stack.append((far, max(bound, diff * diff)))
+            stack.append((near, bound))
+        return neighbours.get_best()
+
+    def query_indices(self, query_point, k=1):
+        """ distances and indices (into the original data) of the k
+        points nearest to query_point, nearest first """
+        if not self:
+            return np.empty(0), np.empty(0, dtype=np.intp)
+        point = np.asarray(query_point, dtype=np.float64)
+        best = self._search(point, KDTreeNeighbours(min(k, len(self))))
+        s_d, indices = zip(*best)
+        return np.sqrt(s_d), np.array(indices, dtype=np.intp)
+
     def query(self, query_point, neighbors=1):
-        """ raise your hand if you have a question"""
-        def nn_search(node, kd_query_point, points, depth, best_neighbours):
-            """ i love the way he defines a function as the first line
-            of another function"""
-            if node is None:
-                return
-
-            if node.left is None and node.right is None:
-                best_neighbours.add(node.point)
-                return
-            # this node is no leaf
-            # select dimension for comparison (based on current depth)
-            axis = depth % len(kd_query_point)
-
-            if kd_query_point[axis] < node.point[axis]:
-                near_subtree = node.left
-                far_subtree = node.right
-            else:
-                near_subtree = node.right
-                far_subtree = node.left
-            # recursively search through the tree until a leaf is found
-            nn_search(near_subtree, kd_query_point, points, depth + 1,
-                      best_neighbours)
-            # while unwinding the recursion, check if the current node
-            # is closer to query point than the current best,
-            # also, until t points have been found, search radius is infinity
-            best_neighbours.add(node.point)
-            if (node.point[axis] - kd_query_point[axis])**2 <= \
-                    best_neighbours.largest_distance:
-                nn_search(far_subtree, kd_query_point, points, depth + 1,
-                          best_neighbours)
-            return
-        # if there's no tree, there's no neighbors
-        if self.root_node is not None:
-            neighbours = KDTreeNeighbours(query_point, neighbors)
-            nn_search(self.root_node, query_point, neighbors, depth=0,
-                      best_neighbours=neighbours)
-            result = neighbours.get_best()
+        """ the nearest points to query_point, nearest first """
+        _, indices = self.query_indices(query_point, neighbors)
+        return [tuple(self.data[i].tolist()) for i in indices]
+
+    def query_batch(self, points, k=1):
+        """ nearest neighbours for many points at once.  Returns
+        (distances, indices) arrays, both shaped (len(points), k) """
+        points = np.asarray(points, dtype=np.float64)
+        points = points.reshape(len(points), -1)
+        k = min(k, len(self))
+        if len(self) <= BRUTE_FORCE_SIZE:
+            return self._brute_force(points, k)
+        distances = np.empty((len(points), k))
+        indices = np.empty((len(points), k), dtype=np.intp)
+        for row, point in enumerate(points):
+            distances[row], indices[row] = self.query_indices(point, k)
+        return distances, indices
+
+    def _brute_force(self, points, k):
+        """ query_batch for small trees, where comparing every point
+        against everything in one numpy pass beats walking the tree """
+        s_d = ((points[:, None, :] - self.data[None, :, :]) ** 2).sum(axis=2)
+        if k < len(self):
+            nearest = np.argpartition(s_d, k - 1, axis=1)[:, :k]
         else:
-            result = []
-        return result
+            nearest = np.broadcast_to(np.arange(len(self)), s_d.shape)
+        nearest_d = np.take_along_axis(s_d, nearest, axis=1)
+        ranked = np.argsort(nearest_d, axis=1, kind='stable')
+        return (np.sqrt(np.take_along_axis(nearest_d, ranked, axis=1)),
+                np.take_along_axis(nearest, ranked, axis=1))
+
+    def query_radius(self, query_point, radius):
+        """ distances and indices of every point within radius of
+        query_point, nearest first """
+        if not self:
+            return np.empty(0), np.empty(0, dtype=np.intp)
+        point = np.asarray(query_point, dtype=np.float64)
+        coords = point.tolist()
+        limit = radius * radius
+        found_d, found_i = [], []
+        stack = [0]
+        while stack:
+            node_start, node_end, axis, split, left, right = \
+                self._nodes[stack.pop()]
+            if left < 0:
+                s_d = ((self.points[node_start:node_end] - point) ** 2) \
+                    .sum(axis=1)
+                hit = s_d <= limit
+                found_d.append(s_d[hit])
+                found_i.append(self.order[node_start:node_end][hit])
+                continue
+            diff = coords[axis] - split
+            if diff - radius <= 0:
+                stack.append(left)
+            if diff + radius >= 0:
+                stack.append(right)
+        s_d = np.concatenate(found_d)
+        indices = np.concatenate(found_i)
+        ranked = np.argsort(s_d, kind='stable')
+        return np.sqrt(s_d[ranked]), indices[ranked]
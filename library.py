@@ -0,0 +1,304 @@
+"""
+The palette library: an index of the sorted palette of every wallpaper
+in a collection, for finding wallpapers by color without theming from
+each of them.
+
+Palettes live in an SQLite database under $XDG_CACHE_HOME/skinit/library,
+one row per image with its palette in hex and in Lab.  Updating is
+incremental.  An image whose size and mtime haven't changed is skipped
+without being read.  One that was only touched keeps its palette if its
+content hash still matches.  New and changed images are extracted on a
+process pool, and rows for images that are gone get dropped.
+
+Queries go through a kdtree.KDTree of every palette color in the
+library.  Building that tree for 100k images takes about ten seconds, so
+the built tree is saved next to the database and reused until the
+library changes.  The tree (Euclidean distance in Lab) only picks the
+candidates; they are then ranked by CIEDE2000.
+
+near_color   -- images with a palette color closest to a color
+near_palette -- images whose palettes are closest to a palette, as the
+                mean distance from each color to the nearest color of
+                the other palette, taken both ways
+"""
+import glob
+import json
+import logging
+import os
+
+import cache
+from utility import create_dir, lazy_import
+
+# the command line reads RESULTS while building its parser
+batch = lazy_import('batch')
+color_functions = lazy_import('color_functions')
+colorspace = lazy_import('colorspace')
+deltae = lazy_import('deltae')
+kdtree = lazy_import('kdtree')
+np = lazy_import('numpy')
+sqlite3 = lazy_import('sqlite3')
+
+LIBRARY_DIR = os.path.join(cache.CACHE_DIR, 'library')
+RESULTS = 10
+# nearest palette colors looked up per query color
+CANDIDATES = 64
+# candidates per result ranked by CIEDE2000 after a first pass in Lab
+SHORTLIST = 4
+# rows written per transaction while updating
+COMMIT_EVERY = 100
+# extraction options that don't change the palette
+IGNORED_OPTIONS = ('max_memory', 'use_cache')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS images (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    hash TEXT NOT NULL,
+    params TEXT NOT NULL,
+    colors TEXT NOT NULL,
+    lab BLOB NOT NULL
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+"""
+
+
+class Index:
+    """the library's palette colors in a KDTree.  Palette i holds
+    tree.data[offsets[i]:offsets[i + 1]] and owner maps each color back
+    to its palette.  colors are the palettes as space separated hex"""
+
+    def __init__(self, tree, paths, colors, sizes):
+        self.tree = tree
+        self.paths = paths
+        self.colors = colors
+        self.offsets = np.concatenate([[0], np.cumsum(sizes)])
+        self.owner = np.repeat(np.arange(len(paths)), sizes)
+
+    def lab(self, palettes):
+        """the Lab colors of some palettes, concatenated, and where each
+        one starts"""
+        starts, ends = self.offsets[palettes], self.offsets[palettes + 1]
+        sizes = ends - starts
+        first = np.cumsum(sizes) - sizes
+        rows = np.repeat(starts - first, sizes) + np.arange(sizes.sum())
+        return self.tree.data[rows], first
+
+    def __len__(self):
+        return len(self.paths)
+
+
+def to_lab(colors):
+    """hex colors to an (N, 3) Lab array"""
+    return colorspace.rgb_to_lab(colorspace.hex_to_rgb(list(colors)))
+
+
+def chamfer(distances, starts):
+    """mean distance from each query color to the nearest color of each
+    palette and back, averaged, given the (query colors, palette colors)
+    distances for palettes concatenated at starts"""
+    sizes = np.diff(np.append(starts, distances.shape[1]))
+    there = np.minimum.reduceat(distances, starts, axis=1).mean(axis=0)
+    back = np.add.reduceat(distances.min(axis=0), starts) / sizes
+    return (there + back) / 2
+
+
+def _extract(img, backend, options):
+    """worker: the sorted palette of img, as hex strings"""
+    return list(color_functions.get(img, backend, **options).hex)
+
+
+class Library:
+    """the palette index in directory"""
+
+    def __init__(self, directory=None):
+        self.directory = directory or LIBRARY_DIR
+        create_dir(self.directory)
+        self.db = sqlite3.connect(os.path.join(self.directory,
+                                               'library.sqlite'))
+        self.db.executescript(SCHEMA)
+        self._index = None
+
+    def close(self):
+        """close the database"""
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    def __len__(self):
+        return self.db.execute("SELECT COUNT(*) FROM images").fetchone()[0]
+
+    @property
+    def generation(self):
+        """bumped every time the library changes"""
+        row = self.db.execute("SELECT value FROM meta WHERE key = "
+                              "'generation'").fetchone()
+        return row[0] if row else 0
+
+    def _changed(self):
+        self.db.execute("INSERT OR REPLACE INTO meta VALUES ('generation', "
+                        "?)", (self.generation + 1,))
+        self._index = None
+
+    def store(self, img, colors, stat, image_hash, params):
+        """add or replace the palette (hex colors) of img, as extracted
+        with params from the file with this stat and hash"""
+        lab = np.asarray(to_lab(colors), dtype=np.float64)
+        self.db.execute("INSERT OR REPLACE INTO images VALUES (?, ?, ?, ?, "
+                        "?, ?, ?)", (img, stat.st_size, stat.st_mtime_ns,
+                                     image_hash, params, ' '.join(colors),
+                                     lab.tobytes()))
+
+    def palette(self, img):
+        """the indexed palette of img as hex colors, or None"""
+        row = self.db.execute("SELECT colors FROM images WHERE path = ?",
+                              (img,)).fetchone()
+        return row[0].split() if row else None
+
+    def _scan(self, source, params):
+        """the images in source that need extracting with params, as
+        {image: (stat, hash)}, and how many others were only touched.
+        The rows of those are brought up to date here"""
+        known = {row[0]: row[1:] for row in self.db.execute(
+            "SELECT path, size, mtime_ns, hash, params FROM images")}
+        todo, touched = {}, 0
+        for img in batch.find_images(source):
+            stat = os.stat(img)
+            row = known.get(img)
+            if row and row[:2] == (stat.st_size, stat.st_mtime_ns) and \
+                    row[3] == params:
+                continue
+            image_hash = cache.image_hash(img)
+            if row and row[2] == image_hash and row[3] == params:
+                self.db.execute("UPDATE images SET size = ?, mtime_ns = ? "
+                                "WHERE path = ?",
+                                (stat.st_size, stat.st_mtime_ns, img))
+                touched += 1
+                continue
+            todo[img] = (stat, image_hash)
+        return todo, touched
+
+    def update(self, source, jobs=None, backend='kmeans', quiet=False,
+               **options):
+        """index new and changed images found in source and forget
+        images that no longer exist.  Returns a list of (image, error
+        message) pairs for the images that failed"""
+        params = json.dumps({'backend': backend, **{
+            key: value for key, value in options.items()
+            if key not in IGNORED_OPTIONS}}, sort_keys=True, default=str)
+        todo, touched = self._scan(source, params)
+
+        gone = [row[0] for row in self.db.execute("SELECT path FROM images")
+                if not os.path.isfile(row[0])]
+        self.db.executemany("DELETE FROM images WHERE path = ?",
+                            [(path,) for path in gone])
+        if gone and not quiet:
+            logging.info("Dropped %s images that no longer exist.",
+                         len(gone))
+
+        failures = []
+        tasks = {img: (img, backend, options) for img in todo}
+        for stored, (img, colors) in enumerate(batch.farm_out(
+                _extract, tasks, failures, jobs, quiet), 1):
+            self.store(img, colors, *todo[img], params)
+            if stored % COMMIT_EVERY == 0:
+                self.db.commit()
+
+        if todo or gone:
+            self._changed()
+        self.db.commit()
+        if not quiet:
+            logging.info("Indexed %s images (%s new or changed, %s "
+                         "touched).", len(self), len(todo) - len(failures),
+                         touched)
+        return failures
+
+    def index(self):
+        """the KDTree index, loaded from disk if the library hasn't
+        changed since it was last built"""
+        if self._index is not None:
+            return self._index
+        generation = self.generation
+        rows = self.db.execute("SELECT path, colors, length(lab) / 24 FROM "
+                               "images ORDER BY path").fetchall()
+        paths = [row[0] for row in rows]
+        colors = [row[1] for row in rows]
+        sizes = np.array([row[2] for row in rows], dtype=np.intp)
+        tree_path = os.path.join(self.directory, 'tree-%s.npz' % generation)
+        try:
+            tree = kdtree.KDTree.load(tree_path)
+            if len(tree) != sizes.sum():
+                raise ValueError("stale tree")
+        except (OSError, ValueError, KeyError):
+            lab = np.frombuffer(b''.join(row[0] for row in self.db.execute(
+                "SELECT lab FROM images ORDER BY path")),
+                dtype=np.float64).reshape(-1, 3)
+            tree = kdtree.KDTree(lab)
+            try:
+                tree.save(tree_path)
+            except OSError as e:
+                logging.info("Couldn't save the library index: %s", e)
+            for stale in glob.glob(os.path.join(self.directory,
+                                                'tree-*.npz')):
+                if stale != tree_path:
+                    try:
+                        os.unlink(stale)
+                    except OSError:
+                        pass
+        self._index = Index(tree, paths, colors, sizes)
+        return self._index
+
+    def near_color(self, color, limit=RESULTS):
+        """up to limit images with a palette color close to color (hex),
+        nearest first, as (Delta E, path, hex colors) tuples"""
+        index = self.index()
+        if not index:
+            return []
+        lab = to_lab([color])
+        k = min(limit * 4, len(index.tree))
+        while True:
+            _, points = index.tree.query_batch(lab, k)
+            owners = index.owner[points[0]]
+            _, first = np.unique(owners, return_index=True)
+            if len(first) >= limit or k == len(index.tree):
+                break
+            k = min(k * 4, len(index.tree))
+        candidates = owners[np.sort(first)]
+        palettes, starts = index.lab(candidates)
+        distances = np.minimum.reduceat(deltae.ciede2000(lab, palettes),
+                                        starts)
+        return self._results(index, candidates, distances, limit)
+
+    def near_palette(self, colors, limit=RESULTS):
+        """up to limit images whose palettes are closest to colors (hex),
+        nearest first, as (Delta E, path, hex colors) tuples"""
+        index = self.index()
+        if not index:
+            return []
+        lab = to_lab(colors)
+        _, points = index.tree.query_batch(lab, min(CANDIDATES,
+                                                    len(index.tree)))
+        candidates = np.unique(index.owner[points])
+        palettes, starts = index.lab(candidates)
+        # CIEDE2000 is slow enough to keep to the best few in plain Lab
+        scores = chamfer(np.linalg.norm(lab[:, None, :] -
+                                        palettes[None, :, :], axis=2), starts)
+        candidates = candidates[np.argsort(scores, kind='stable')
+                                [:limit * SHORTLIST]]
+        palettes, starts = index.lab(candidates)
+        scores = chamfer(deltae.ciede2000(lab[:, None, :],
+                                          palettes[None, :, :]), starts)
+        return self._results(index, candidates, scores, limit)
+
+    @staticmethod
+    def _results(index, candidates, distances, limit):
+        ranked = np.argsort(distances, kind='stable')[:limit]
+        return [(float(distances[i]), index.paths[candidates[i]],
+                 index.colors[candidates[i]].split()) for i in ranked]
@@ -0,0 +1,290 @@
+"""
+Orders a palette by treating it as a shortest Hamiltonian path problem
+over a precomputed distance matrix: the path starts at a fixed color,
+visits every other color exactly once and ends wherever is cheapest.
+
+A greedy nearest-neighbour path is built first, then refined with
+2-opt (reverse a stretch of the path) and Or-opt (move a run of up to
+three colors elsewhere) passes.  Refinement stops when a pass finds no
+improvement, after max_passes passes, or once time_budget seconds have
+gone by, whichever comes first.  The time budget is only checked
+between passes and ties are always broken towards the lowest index, so
+for a given matrix the output is the same on every run unless the
+budget runs out first.
+
+The full matrix costs O(N^2) to fill and each pass O(N^2) to search,
+so palettes bigger than MATRIX_SIZE go to candidate_path instead: each
+color only looks at its nearest few neighbours (from a KDTree) when
+building and improving the path, which keeps the work close to
+O(N log N).
+"""
+import time
+
+from kdtree import KDTree
+from utility import lazy_import
+
+np = lazy_import('numpy')
+
+EPSILON = 1e-9
+# largest palette ordered with a full distance matrix
+MATRIX_SIZE = 64
+# candidates per color in candidate_path
+NEIGHBOURS = 10
+
+
+def nearest_neighbor_path(dist, start=0):
+    """greedy path: from start, always step to the closest unvisited
+    color"""
+    size = len(dist)
+    visited = np.zeros(size, dtype=bool)
+    path = [start]
+    visited[start] = True
+    for _ in range(size - 1):
+        row = np.where(visited, np.inf, dist[path[-1]])
+        nearest = int(row.argmin())
+        path.append(nearest)
+        visited[nearest] = True
+    return np.array(path)
+
+
+def path_length(dist, path):
+    """total distance along a path"""
+    path = np.asarray(path)
+    return float(dist[path[:-1], path[1:]].sum())
+
+
+def _with_sink(dist):
+    """pad the matrix with a 'sink' node that is zero distance from
+    everything.  Parking the sink at the end of the path turns the open
+    path into a closed one, so the usual 2-opt move formulas apply"""
+    size = len(dist)
+    padded = np.zeros((size + 1, size + 1))
+    padded[:size, :size] = dist
+    return padded
+
+
+def two_opt_pass(dist, path):
+    """one pass of 2-opt over a path ending in the sink node.  Reverses
+    path[i:j + 1] whenever that shortens the path.  Returns True if the
+    path was changed"""
+    improved = False
+    last = len(path) - 1  # the sink never moves
+    for i in range(1, last - 1):
+        a, b = path[i - 1], path[i]
+        c, d = path[i + 1:last], path[i + 2:last + 1]
+        gain = dist[a, b] + dist[c, d] - dist[a, c] - dist[b, d]
+        best = int(gain.argmax())
+        if gain[best] > EPSILON:
+            j = i + 1 + best
+            path[i:j + 1] = path[i:j + 1][::-1].copy()
+            improved = True
+    return improved
+
+
+def _best_move(dist, path, edges, i, length):
+    """where moving the run path[i:i + length] saves the most, as
+    (saving, spot, flip): the run goes between path[spot] and
+    path[spot + 1], reversed if flip.  edges are the lengths of the
+    path's edges"""
+    a, b = path[:-1], path[1:]
+    first, end = path[i], path[i + length - 1]
+    prev, nxt = path[i - 1], path[i + length]
+    forward = dist[a, first] + dist[end, b] - edges
+    backward = dist[a, end] + dist[first, b] - edges
+    costs = np.minimum(forward, backward)
+    # edges touching the run aren't somewhere else to go
+    costs[i - 1:i + length] = np.inf
+    spot = int(costs.argmin())
+    return (dist[prev, first] + dist[end, nxt] - dist[prev, nxt]
+            - costs[spot], spot, backward[spot] < forward[spot])
+
+
+def _move(path, i, length, spot, flip):
+    """path with the run path[i:i + length] moved to after path[spot],
+    reversed if flip"""
+    segment = path[i:i + length]
+    if flip:
+        segment = segment[::-1]
+    rest = np.concatenate((path[:i], path[i + length:]))
+    if spot > i:
+        spot -= length
+    return np.concatenate((rest[:spot + 1], segment, rest[spot + 1:]))
+
+
+def or_opt_pass(dist, path, max_segment=3):
+    """one pass of Or-opt over a path ending in the sink node.  Moves
+    runs of up to max_segment colors, in either direction, to the
+    cheapest other spot in the path.  Returns the path and whether it
+    was changed"""
+    improved = False
+    edges = dist[path[:-1], path[1:]]
+    for length in range(1, max_segment + 1):
+        i = 1
+        while i + length < len(path):
+            saving, spot, flip = _best_move(dist, path, edges, i, length)
+            if saving > EPSILON:
+                path = _move(path, i, length, spot, flip)
+                edges = dist[path[:-1], path[1:]]
+                improved = True
+            i += 1
+    return path, improved
+
+
+def shortest_path(dist, start=0, time_budget=0.25, max_passes=50):
+    """order the colors of an (N, N) distance matrix into a short path
+    beginning at start.  Returns a list of indices"""
+    dist = np.asarray(dist, dtype=np.float64)
+    if len(dist) < 3:
+        return [start] + [i for i in range(len(dist)) if i != start]
+
+    deadline = time.perf_counter() + time_budget
+    padded = _with_sink(dist)
+    path = np.append(nearest_neighbor_path(dist, start), len(dist))
+
+    for _ in range(max_passes):
+        improved = two_opt_pass(padded, path)
+        path, moved = or_opt_pass(padded, path)
+        if not (improved or moved) or time.perf_counter() > deadline:
+            break
+
+    return [int(i) for i in path[:-1]]
+
+
+def _candidates(points, metric, neighbours):
+    """the nearest neighbours of every point, as lists of (distance,
+    index) pairs sorted by metric.  Neighbours are found by euclidean
+    distance, then ranked by metric"""
+    size = len(points)
+    k = min(neighbours, size - 1)
+    _, nearest = KDTree(points).query_batch(points, k + 1)
+    # drop each point from its own list (not always first, if duplicated)
+    is_self = nearest == np.arange(size)[:, None]
+    nearest = np.take_along_axis(nearest, np.argsort(is_self, axis=1,
+                                                     kind='stable'),
+                                 axis=1)[:, :k]
+    distances = metric(points[:, None, :], points[nearest])
+    ranked = np.argsort(distances, axis=1, kind='stable')
+    distances = np.take_along_axis(distances, ranked, axis=1).tolist()
+    nearest = np.take_along_axis(nearest, ranked, axis=1).tolist()
+    return [list(zip(row_d, row_i)) for row_d, row_i in zip(distances,
+                                                             nearest)]
+
+
+def _lookup(points, metric, candidates):
+    """dist(i, j), the metric between points i and j, remembered and
+    seeded with the candidate pairs.  None (past the end of the path) is
+    no distance from anything"""
+    known = {}
+    for i, row in enumerate(candidates):
+        for distance, j in row:
+            known[(min(i, j), max(i, j))] = distance
+
+    def dist(i, j):
+        if i is None or j is None:
+            return 0.0
+        key = (min(i, j), max(i, j))
+        if key not in known:
+            known[key] = float(metric(points[i], points[j]))
+        return known[key]
+    return dist
+
+
+def _greedy_path(points, metric, candidates, start):
+    """from start, step to the closest unvisited candidate, or to the
+    closest unvisited color if every candidate has been visited"""
+    size = len(points)
+    visited = [False] * size
+    visited[start] = True
+    path = [start]
+    for _ in range(size - 1):
+        step = next((j for _, j in candidates[path[-1]] if not visited[j]),
+                    None)
+        if step is None:
+            rest = [j for j in range(size) if not visited[j]]
+            step = rest[int(metric(points[path[-1]],
+                                   points[rest]).argmin())]
+        visited[step] = True
+        path.append(step)
+    return path
+
+
+def _reverse(path, position, i, j):
+    """reverse path[i:j + 1], keeping position (the index of each color
+    in path) up to date"""
+    path[i:j + 1] = path[i:j + 1][::-1]
+    for k in range(i, j + 1):
+        position[path[k]] = k
+
+
+def two_opt_forward(path, position, candidates, dist):
+    """one pass of 2-opt moves that link a color to a candidate further
+    along the path: a -> b ... c -> d  becomes  a -> c ... b -> d.
+    Returns True if the path was changed"""
+    improved = False
+    size = len(path)
+    for i in range(size - 1):
+        a, b = path[i], path[i + 1]
+        current = dist(a, b)
+        for distance, c in candidates[a]:
+            if distance >= current - EPSILON:
+                break
+            j = position[c]
+            if j <= i + 1:
+                continue
+            d = path[j + 1] if j + 1 < size else None
+            if current + dist(c, d) - distance - dist(b, d) > EPSILON:
+                _reverse(path, position, i + 1, j)
+                improved = True
+                break
+    return improved
+
+
+def two_opt_backward(path, position, candidates, dist):
+    """one pass of 2-opt moves that link a color to a candidate earlier
+    in the path: e -> c ... p -> a  becomes  e -> p ... c -> a.
+    Returns True if the path was changed"""
+    improved = False
+    for i in range(2, len(path)):
+        p, a = path[i - 1], path[i]
+        current = dist(p, a)
+        for distance, c in candidates[a]:
+            if distance >= current - EPSILON:
+                break
+            j = position[c]
+            if j < 1 or j >= i - 1:
+                continue
+            e = path[j - 1]
+            if current + dist(e, c) - distance - dist(e, p) > EPSILON:
+                _reverse(path, position, j, i - 1)
+                improved = True
+                break
+    return improved
+
+
+def candidate_path(points, metric, start=0, *, neighbours=NEIGHBOURS,
+                   time_budget=0.25, max_passes=50):
+    """order an (N, D) array of points into a short path beginning at
+    start, without a full distance matrix.  metric(a, b) is a
+    broadcasting distance between arrays of points; it is only
+    evaluated for candidate pairs and the few others the search needs.
+    Greedy construction over the candidate lists, then 2-opt moves that
+    create a candidate edge.  Returns a list of indices"""
+    points = np.asarray(points, dtype=np.float64)
+    size = len(points)
+    if size < 3:
+        return [start] + [i for i in range(size) if i != start]
+
+    candidates = _candidates(points, metric, neighbours)
+    dist = _lookup(points, metric, candidates)
+    path = _greedy_path(points, metric, candidates, start)
+    # where each color is in the path
+    position = np.argsort(path).tolist()
+
+    deadline = time.perf_counter() + time_budget
+    for _ in range(max_passes):
+        forward = two_opt_forward(path, position, candidates, dist)
+        backward = two_opt_backward(path, position, candidates, dist)
+        if not (forward or backward) or time.perf_counter() > deadline:
+            break
+
+    return [int(i) for i in path]
@@ -0,0 +1,159 @@
+"""
+The theme pipeline for a single image, shared by the command line and
+the daemon: set the wallpaper, get a palette and make it readable,
+write the theme files, recolor the desktop theme and send the colors
+to open terminals.
+
+The stages form a dependency graph, run by an asyncio orchestrator on
+a thread pool, so nothing waits on a stage it doesn't need:
+
+    wallpaper
+    palette --+-- render -- recolor -- reload
+              '-- send
+
+The wallpaper D-Bus call overlaps palette extraction, and the terminal
+writes run alongside the theme files once the palette is ready.
+Recoloring waits for the templates, since it installs the desktop
+theme's files, including the colors file rendered into it.  The
+wallpaper stage queues and flushes its requests on a queue of its own
+(desktop.DesktopBackend.queue()), so reload is the only stage that
+flushes the theme and color scheme changes, once both stages that
+queue them are done.
+
+Each stage has its own timeout (TIMEOUTS).  One that fails or times
+out is logged and skips the stages depending on it; only a missing
+palette fails the whole run.  Python can't stop a thread, so a
+stage that timed out may still finish in the background.
+
+Each stage is wrapped in stageprof.stage() for --profile, and the whole
+graph in stageprof.run().  Stages that run at the same time share the
+process, so their CPU times overlap; the total is the elapsed time and
+memory peak of the whole graph.
+"""
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+import color_functions
+import contrast
+import desktop
+import export
+import extract
+import recolor
+import stageprof
+
+# seconds each stage may take
+TIMEOUTS = {
+    'wallpaper': 10,
+    'palette': 120,
+    'render': 30,
+    'recolor': 60,
+    'send': 10,
+    'reload': 30,
+}
+
+
+class Skipped(Exception):
+    """a stage didn't run because one it depends on didn't finish"""
+
+
+async def run_graph(stages, timeouts=None):
+    """run stages, a dict of name => (dependencies, function), each on a
+    worker thread as soon as its dependencies are done.  Functions are
+    passed the dict of results so far; dependencies must come before the
+    stages that need them.  Returns (results, errors), keyed by stage"""
+    timeouts = TIMEOUTS if timeouts is None else timeouts
+    loop = asyncio.get_running_loop()
+    results, tasks = {}, {}
+    pool = ThreadPoolExecutor(max_workers=len(stages))
+
+    async def run(name):
+        dependencies, function = stages[name]
+        for dependency in dependencies:
+            try:
+                await tasks[dependency]
+            except Exception as e:
+                raise Skipped("%s didn't finish" % dependency) from e
+        results[name] = await asyncio.wait_for(
+            loop.run_in_executor(pool, function, results),
+            timeouts.get(name))
+        return results[name]
+
+    for name in stages:
+        tasks[name] = asyncio.ensure_future(run(name))
+    try:
+        outcomes = await asyncio.gather(*tasks.values(),
+                                        return_exceptions=True)
+    finally:
+        # don't wait on threads that timed out
+        pool.shutdown(wait=False)
+    errors = {name: outcome for name, outcome in zip(tasks, outcomes)
+              if isinstance(outcome, Exception)}
+    return results, errors
+
+
+def apply(img, splash=False, vte_fix=False, quiet=False, extended=False,
+          set_wallpaper=True, backend='kmeans', use_cache=True,
+          readable=True, timeouts=None, **options):
+    """theme the desktop from img.  Returns the palette.  Raises
+    extract.ExtractionError if no palette could be extracted"""
+    timeouts = TIMEOUTS if timeouts is None else timeouts
+
+    def wallpaper(_):
+        with stageprof.stage('wallpaper'):
+            queue = desktop.backend().queue()
+            export.export_wallpaper(img, splash, queue)
+            queue.flush()
+
+    def palette(_):
+        colors = color_functions.get(img, backend, use_cache=use_cache,
+                                     **options)
+        if readable:
+            with stageprof.stage('contrast'):
+                colors = contrast.enforce(colors)
+        return colors
+
+    def render(results):
+        with stageprof.stage('render'):
+            export.make_theme_files(img, results['palette'])
+
+    def recolor_theme(results):
+        with stageprof.stage('recolor'):
+            if recolor.recolor_theme(results['palette']):
+                export.update_theme('SkinIt')
+
+    def reload(_):
+        with stageprof.stage('reload'):
+            desktop.backend().flush()
+
+    def send(results):
+        with stageprof.stage('send'):
+            export.send(results['palette'], to_send=not splash,
+                        vte_fix=vte_fix, quiet=quiet, extended=extended)
+
+    stages = {'palette': ((), palette)}
+    if set_wallpaper:
+        stages['wallpaper'] = ((), wallpaper)
+    stages['render'] = (('palette',), render)
+    stages['recolor'] = (('render',), recolor_theme)
+    stages['send'] = (('palette',), send)
+    stages['reload'] = (('render', 'recolor'), reload)
+
+    with stageprof.run():
+        results, errors = asyncio.run(run_graph(stages, timeouts))
+    error = errors.pop('palette', None)
+    if isinstance(error, asyncio.TimeoutError):
+        raise extract.ExtractionError(
+            "Getting a palette from %s took over %s seconds."
+            % (img, timeouts['palette']))
+    if error:
+        raise error
+    for name, error in errors.items():
+        if isinstance(error, asyncio.TimeoutError):
+            logging.warning("The %s stage timed out after %s seconds.",
+                            name, timeouts.get(name))
+        elif isinstance(error, Skipped):
+            logging.warning("Skipped the %s stage, %s.", name, error)
+        else:
+            logging.error("The %s stage failed: %s", name, error)
+    return results['palette']
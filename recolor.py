@@ -0,0 +1,151 @@
+"""
+Recolors the Plasma desktop theme to match the palette.  Every .svgz
+asset under desktoptheme/skinit is decompressed, each fill, stroke and
+stop-color is replaced with the nearest palette color (in Lab), and the
+result is recompressed with a fixed gzip timestamp, so the same asset
+and palette always give the same bytes.  The recolored theme, along
+with copies of its other files, goes to the user's Plasma theme folder;
+the assets in the repository are never touched.
+
+Assets are recolored across a process pool.  Results are cached under
+$XDG_CACHE_HOME/skinit/svgz by (asset hash, palette hash), so an asset
+is only ever processed once per palette, and installed files that
+already hold the right bytes aren't rewritten.
+"""
+import gzip
+import hashlib
+import logging
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+
+import cache
+import colorspace
+from color_functions import Palette
+from kdtree import KDTree
+from utility import atomic_write, create_dir
+
+SOURCE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          'desktoptheme', 'skinit')
+OUTPUT_DIR = os.path.join(os.environ.get('XDG_DATA_HOME') or
+                          os.path.expanduser('~/.local/share'),
+                          'plasma', 'desktoptheme', 'skinit')
+CACHE_DIR = os.path.join(cache.CACHE_DIR, 'svgz')
+MAX_ENTRIES = 2048
+
+COLOR = re.compile(rb'((?:fill|stroke|stop-color|flood-color|color)'
+                   rb'\s*[:=]\s*["\']?)(#[0-9a-fA-F]{6}|#[0-9a-fA-F]{3})'
+                   rb'(?![0-9a-fA-F])')
+# below this many assets to recolor, a process pool costs more than it saves
+POOL_SIZE = 8
+
+
+def palette_hash(colors):
+    """hash of a palette, for cache keys"""
+    return hashlib.blake2b(''.join(colors.hex).encode(),
+                           digest_size=8).hexdigest()
+
+
+def _expand(color):
+    """b'#abc' or b'#AABBCC' to '#aabbcc'"""
+    color = color.decode().lower()
+    if len(color) == 4:
+        color = '#' + ''.join(x * 2 for x in color[1:])
+    return color
+
+
+def recolor_svg(data, colors):
+    """svg source (bytes) with every color mapped to its nearest
+    palette color"""
+    found = sorted({_expand(match.group(2))
+                    for match in COLOR.finditer(data)})
+    if not found:
+        return data
+    lab = colorspace.rgb_to_lab(colorspace.hex_to_rgb(found))
+    _, nearest = KDTree(colors.lab).query_batch(lab, 1)
+    mapping = {color: colors.hex[index].encode()
+               for color, index in zip(found, nearest[:, 0])}
+    return COLOR.sub(lambda match: match.group(1) +
+                     mapping[_expand(match.group(2))], data)
+
+
+def recolor_asset(source, target, palette_hex):
+    """recolor one .svgz file into target"""
+    with open(source, 'rb') as file:
+        data = gzip.decompress(file.read())
+    data = recolor_svg(data, Palette.from_hex(palette_hex))
+    atomic_write(gzip.compress(data, mtime=0), target)
+    return target
+
+
+def assets(source_dir=SOURCE_DIR):
+    """paths of the theme's files relative to source_dir, skipping
+    broken links"""
+    found = []
+    for root, _, files in os.walk(source_dir):
+        for name in files:
+            path = os.path.join(root, name)
+            if os.path.isfile(path):
+                found.append(os.path.relpath(path, source_dir))
+    return sorted(found)
+
+
+def _install(source, target):
+    """copy source over target unless they already match.  Returns True
+    if target was written"""
+    with open(source, 'rb') as file:
+        data = file.read()
+    try:
+        with open(target, 'rb') as file:
+            if file.read() == data:
+                return False
+    except OSError:
+        pass
+    create_dir(os.path.dirname(target))
+    atomic_write(data, target)
+    return True
+
+
+def recolor_theme(colors, source_dir=SOURCE_DIR, output_dir=OUTPUT_DIR,
+                  cache_dir=CACHE_DIR, jobs=None):
+    """recolor the whole theme from colors into output_dir.  Returns the
+    paths that changed"""
+    if os.path.realpath(output_dir) == os.path.realpath(source_dir):
+        logging.warning("%s is linked to SkinIt's own theme, not "
+                        "recoloring it.", output_dir)
+        return []
+    colors = Palette.from_colors(colors)
+    create_dir(cache_dir)
+    palette_key = palette_hash(colors)
+    cached, todo = {}, []
+    for name in assets(source_dir):
+        source = os.path.join(source_dir, name)
+        if not name.endswith('.svgz'):
+            cached[name] = source
+            continue
+        with open(source, 'rb') as file:
+            asset_key = hashlib.blake2b(file.read(),
+                                        digest_size=8).hexdigest()
+        path = os.path.join(cache_dir, '%s-%s.svgz' % (asset_key,
+                                                       palette_key))
+        cached[name] = path
+        if os.path.exists(path):
+            os.utime(path)
+        else:
+            todo.append((source, path))
+
+    if len(todo) < POOL_SIZE:
+        for source, path in todo:
+            recolor_asset(source, path, colors.hex)
+    else:
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            futures = [pool.submit(recolor_asset, source, path, colors.hex)
+                       for source, path in todo]
+            for future in futures:
+                future.result()
+    if todo:
+        logging.debug("Recolored %s theme assets.", len(todo))
+        cache.evict(cache_dir, MAX_ENTRIES, '.svgz')
+
+    return [os.path.join(output_dir, name) for name, path in cached.items()
+            if _install(path, os.path.join(output_dir, name))]
@@ -0,0 +1,123 @@
+"""
+Renders the .skinit templates in the templates folder.  The first two
+lines of a template are its header:
+   1) Full destination path and filename
+   2) Type of color code required (any key of FORMATS)
+and the rest is the body, with [colorN] and [wallpaper] placeholders.
+N can go as high as the palette size (see -n).
+
+Templates are parsed once into a list of segments (literal text,
+placeholder, literal text, ...) and kept in a cache keyed by the file's
+mtime, so rendering is a single join over the segments.
+"""
+import glob
+import os
+import re
+
+TEMPLATE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            'templates')
+
+PLACEHOLDER = re.compile(r'\[(?:color(\d+)|(wallpaper))\]')
+WALLPAPER = -1
+
+FORMATS = {
+    'hex': lambda color: color.hex_value,
+    'rgb': lambda color: str(color.rgb_value),
+    'rgba': lambda color: 'rgba(%s, %s, %s, 1.0)' % color.rgb_value,
+    'float': lambda color: ', '.join('%.4f' % (x / 255)
+                                     for x in color.rgb_value),
+    'hsv': lambda color: '%s, %s, %s' % color.hsv_value,
+    'decimal': lambda color: str(int(color.hex_value.lstrip('#'), 16)),
+}
+
+_compiled = {}
+
+
+class Template:
+    """a parsed .skinit template.  segments alternates between literal
+    strings and placeholders: a color index, or WALLPAPER"""
+
+    def __init__(self, path, output, color_type, segments):
+        self.path = path
+        self.output = output
+        self.color_type = color_type
+        self.segments = segments
+
+    def render(self, img, values):
+        """render with values, a list of already formatted colors.
+        Placeholders past the end of a small palette wrap around to its
+        start, so templates written for 16 colors work with any size"""
+        parts = []
+        for segment in self.segments:
+            if isinstance(segment, str):
+                parts.append(segment)
+            elif segment == WALLPAPER:
+                parts.append(img)
+            elif values:
+                parts.append(values[segment % len(values)])
+            else:
+                parts.append('[color%s]' % segment)
+        return ''.join(parts)
+
+
+def parse(path):
+    """parse a template file into a Template"""
+    with open(path, 'r') as _input:
+        output = _input.readline().rstrip('\n')
+        color_type = _input.readline().rstrip('\n')
+        body = _input.read()
+    segments = []
+    position = 0
+    for match in PLACEHOLDER.finditer(body):
+        segments.append(body[position:match.start()])
+        index, _ = match.groups()
+        segments.append(WALLPAPER if index is None else int(index))
+        position = match.end()
+    segments.append(body[position:])
+    return Template(path, output, color_type, segments)
+
+
+def compile_template(path):
+    """the parsed template for path, re-parsed only when the file has
+    changed since it was last compiled"""
+    mtime = os.stat(path).st_mtime_ns
+    cached = _compiled.get(path)
+    if cached is None or cached[0] != mtime:
+        cached = _compiled[path] = (mtime, parse(path))
+    return cached[1]
+
+
+def templates(template_dir=TEMPLATE_DIR):
+    """paths of all the .skinit templates in a folder"""
+    return sorted(glob.glob(os.path.join(template_dir, '*.skinit')))
+
+
+def template_name(template):
+    """a template's file name without the .skinit extension"""
+    return os.path.basename(template)[:-len('.skinit')]
+
+
+def render(template, img, colors):
+    """render one template.  Returns its destination path and the
+    rendered text, or None for an unsupported color type"""
+    compiled = compile_template(template)
+    if compiled.color_type not in FORMATS:
+        return None
+    values = [FORMATS[compiled.color_type](color) for color in colors]
+    return compiled.output, compiled.render(img, values)
+
+
+def render_all(img, colors, template_dir=TEMPLATE_DIR):
+    """render every template, yielding (template, destination, text).
+    Each color format is only worked out once per call"""
+    formatted = {}
+    for template in templates(template_dir):
+        compiled = compile_template(template)
+        color_type = compiled.color_type
+        if color_type not in FORMATS:
+            continue
+        if color_type not in formatted:
+            formatted[color_type] = [FORMATS[color_type](color)
+                                     for color in colors]
+        yield (template, compiled.output,
+               compiled.render(img, formatted[color_type]))
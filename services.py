@@ -0,0 +1,34 @@
+"""
+Lazily created D-Bus proxies.  Nothing talks to the session bus until a
+proxy is first asked for, so commands that never touch Plasma (--help,
+-p, batch) start quickly and work without a session bus at all.  Each
+accessor connects once and returns the same proxy from then on.
+"""
+import functools
+
+
+@functools.lru_cache(maxsize=None)
+def bus():
+    """the D-Bus session bus"""
+    from pydbus import SessionBus  # pylint: disable=import-outside-toplevel
+    return SessionBus()
+
+
+@functools.lru_cache(maxsize=None)
+def plasma_shell():
+    """proxy for the running plasmashell"""
+    return bus().get('org.kde.plasmashell', '/PlasmaShell')
+
+
+@functools.lru_cache(maxsize=None)
+def notifications():
+    """proxy for the desktop notification service"""
+    return bus().get('org.freedesktop.Notifications',
+                     '/org/freedesktop/Notifications')
+
+
+def emit_signal(path, interface, name, signature, args):
+    """broadcast a signal on the session bus"""
+    from gi.repository import GLib  # pylint: disable=import-outside-toplevel
+    bus().con.emit_signal(None, path, interface, name,
+                          GLib.Variant(signature, args))
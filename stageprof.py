@@ -0,0 +1,155 @@
+"""
+Per-stage instrumentation.  The pipeline wraps each stage in
+stageprof.stage(name), which costs nothing unless a Profiler has been
+started (with --profile on the command line).  For every stage a
+profiler records:
+
+wall_ms      -- elapsed time
+cpu_ms       -- CPU time of this process
+children_ms  -- CPU time of subprocesses that finished during the stage
+
+Pipeline stages overlap, so the total is measured around the whole run
+(stageprof.run()) rather than added up from the stages.  So is the
+memory peak (peak_kib, the tracemalloc allocation peak above what was
+already allocated when the run began): tracemalloc only has one peak
+for the whole process, which stages running at the same time would
+keep resetting under each other.
+
+One stage can also be run under cProfile, with the stats dumped to a
+file for pstats or snakeviz.
+"""
+import contextlib
+import json
+import resource
+import time
+
+from utility import lazy_import
+
+cProfile = lazy_import('cProfile')
+tracemalloc = lazy_import('tracemalloc')
+
+STAGES = ('cache', 'wallpaper', 'extract', 'sort', 'contrast', 'render',
+          'recolor', 'reload', 'send')
+FORMATS = ('json', 'table')
+
+_profiler = None
+
+
+def _children_time():
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+class Profiler:
+    """collects measurements for each stage, in the order they ran"""
+
+    def __init__(self, cprofile_stage=None, cprofile_output=None):
+        self.stages = []
+        self.total = None
+        self.cprofile_stage = cprofile_stage
+        self.cprofile_output = cprofile_output or \
+            'skinit-%s.prof' % cprofile_stage
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """measure the body of the with block as stage name"""
+        profile = cProfile.Profile() if name == self.cprofile_stage \
+            else None
+        children = _children_time()
+        cpu = time.process_time()
+        wall = time.perf_counter()
+        if profile:
+            profile.enable()
+        try:
+            yield
+        finally:
+            if profile:
+                profile.disable()
+                profile.dump_stats(self.cprofile_output)
+            self.stages.append({
+                'stage': name,
+                'wall_ms': (time.perf_counter() - wall) * 1000,
+                'cpu_ms': (time.process_time() - cpu) * 1000,
+                'children_ms': (_children_time() - children) * 1000,
+            })
+
+    @contextlib.contextmanager
+    def run(self):
+        """measure the body of the with block as the total"""
+        tracing, base = tracemalloc.is_tracing(), 0
+        if tracing:
+            tracemalloc.reset_peak()
+            base = tracemalloc.get_traced_memory()[0]
+        children = _children_time()
+        cpu = time.process_time()
+        wall = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.total = {
+                'wall_ms': (time.perf_counter() - wall) * 1000,
+                'cpu_ms': (time.process_time() - cpu) * 1000,
+                'children_ms': (_children_time() - children) * 1000,
+                'peak_kib': (tracemalloc.get_traced_memory()[1] - base) /
+                            1024 if tracing else None,
+            }
+
+    def totals(self):
+        """the measured total, or the stages added up if there was no
+        run() around them"""
+        if self.total is not None:
+            return self.total
+        return {'peak_kib': None, **{
+            key: sum(entry[key] for entry in self.stages)
+            for key in ('wall_ms', 'cpu_ms', 'children_ms')}}
+
+    def report(self, output_format='table'):
+        """the measurements as JSON or as a table"""
+        if output_format == 'json':
+            return json.dumps({'stages': self.stages,
+                               'total': self.totals()}, indent=4)
+        lines = ["%-10s %10s %10s %12s %10s" % ("stage", "wall ms", "cpu ms",
+                                                "children ms", "peak KiB")]
+        for entry in self.stages:
+            lines.append("%-10s %10.1f %10.1f %12.1f" % (
+                entry['stage'], entry['wall_ms'], entry['cpu_ms'],
+                entry['children_ms']))
+        total = self.totals()
+        peak = total['peak_kib']
+        lines.append("%-10s %10.1f %10.1f %12.1f %10s" % (
+            "total", total['wall_ms'], total['cpu_ms'],
+            total['children_ms'], '-' if peak is None else '%.0f' % peak))
+        return '\n'.join(lines)
+
+
+def start(memory=True, **options):
+    """start profiling every stage from now on"""
+    global _profiler
+    if memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+    _profiler = Profiler(**options)
+    return _profiler
+
+
+def stop():
+    """stop profiling.  Returns the profiler, or None if none was
+    running"""
+    global _profiler
+    profiler, _profiler = _profiler, None
+    if profiler and tracemalloc.is_tracing():
+        tracemalloc.stop()
+    return profiler
+
+
+def stage(name):
+    """context manager measuring stage name, if profiling"""
+    if _profiler is None:
+        return contextlib.nullcontext()
+    return _profiler.stage(name)
+
+
+def run():
+    """context manager measuring a whole run of stages, if profiling"""
+    if _profiler is None:
+        return contextlib.nullcontext()
+    return _profiler.run()
@@ -0,0 +1,52 @@
+"""
+Tests for broadcast.py, against pseudo-terminals.
+"""
+import os
+import sys
+import time
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+# pylint: disable=wrong-import-position
+from broadcast import broadcast, OK, TIMEOUT  # noqa: E402
+
+
+class BroadcastTest(unittest.TestCase):
+    """broadcast() to ptys whose readers do or don't keep up"""
+
+    def open_pty(self):
+        """a pty whose slave end can be written by path"""
+        master, slave = os.openpty()
+        self.addCleanup(os.close, master)
+        self.addCleanup(os.close, slave)
+        return master, os.ttyname(slave)
+
+    def test_writes_to_a_reader(self):
+        master, path = self.open_pty()
+        self.assertEqual(broadcast('\033]4;0;#000000\033\\', [path]),
+                         {path: OK})
+        self.assertIn(b'#000000', os.read(master, 1024))
+
+    def test_stuck_reader_times_out(self):
+        # nothing reads the master, so the pty's buffer fills up
+        _, stuck = self.open_pty()
+        master, path = self.open_pty()
+        start = time.monotonic()
+        results = broadcast(b'x' * (1 << 20), [stuck], timeout=0.2)
+        self.assertLess(time.monotonic() - start, 2)
+        self.assertEqual(results, {stuck: TIMEOUT})
+        # and a stuck terminal doesn't hold up the others
+        results = broadcast(b'y', [stuck, path], timeout=0.2)
+        self.assertEqual(results[path], OK)
+        self.assertEqual(os.read(master, 1), b'y')
+
+    def test_missing_terminal(self):
+        results = broadcast('x', ['/dev/pts/no-such-terminal'])
+        self.assertNotIn(results['/dev/pts/no-such-terminal'],
+                         (OK, TIMEOUT))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,48 @@
+"""
+Tests for the histogram backend's binning.
+"""
+import os
+import sys
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+# pylint: disable=wrong-import-position
+import histogram  # noqa: E402
+from utility import lazy_import  # noqa: E402
+
+np = lazy_import('numpy')
+
+
+@unittest.skipIf(np is None, "needs numpy")
+class FromSlicesTest(unittest.TestCase):
+    """Histogram.from_slices against a single pass"""
+
+    def setUp(self):
+        self.pixels = np.random.default_rng(0).integers(
+            0, 256, (100003, 3), dtype=np.uint8)
+
+    def test_process_pool_matches_single_pass(self):
+        serial = histogram.Histogram.from_pixels(self.pixels)
+        # the pool's workers bin in their own processes, so from_pixels
+        # is never called here when the parallel path runs
+        with mock.patch.object(histogram.Histogram, 'from_pixels') as single:
+            parallel = histogram.Histogram.from_slices(
+                self.pixels, jobs=3, parallel_pixels=0)
+        single.assert_not_called()
+        np.testing.assert_array_equal(parallel.counts, serial.counts)
+        np.testing.assert_allclose(parallel.sums, serial.sums)
+        np.testing.assert_allclose(parallel.palette(16), serial.palette(16))
+
+    def test_small_samples_take_one_pass(self):
+        with mock.patch.object(histogram.Histogram, 'from_pixels',
+                               wraps=histogram.Histogram.from_pixels) \
+                as single:
+            histogram.Histogram.from_slices(self.pixels, jobs=3)
+        single.assert_called_once()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,18 +1,35 @@
 """
 Various utility functions needed by other modules
 """
-import subprocess
+import importlib.util
 import logging
 import sys
 import os
-import platform
-from pydbus import SessionBus
 
-bus = SessionBus()
-plasma_shell = bus.get('org.kde.plasmashell', '/PlasmaShell')
-notifications = bus.get('org.freedesktop.Notifications', '/org/freedesktop/Notifications')
+OS = os.uname().sysname
 
-OS = platform.uname()[0]
+
+def lazy_import(name):
+    """import a module, deferring the actual loading until one of its
+    attributes is first used.  Returns None if it isn't installed"""
+    if name in sys.modules:
+        return sys.modules[name]
+    try:
+        spec = importlib.util.find_spec(name)
+    except ModuleNotFoundError:
+        spec = None
+    if spec is None:
+        return None
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
+
+
+subprocess = lazy_import('subprocess')
+tempfile = lazy_import('tempfile')
 
 
 def open_read(_input):
@@ -25,6 +42,27 @@ def open_write(_data, _output):
         file.writelines(_data)
 
 
+def atomic_write(_data, _output):
+    """write a file by way of a temp file in the same directory and
+    a rename, so readers never see it half written.  _data may be text
+    or bytes"""
+    directory = os.path.dirname(os.path.abspath(_output))
+    fd, tmp = tempfile.mkstemp(dir=directory, prefix='.skinit-')
+    try:
+        try:
+            mode = os.stat(_output).st_mode & 0o777
+        except FileNotFoundError:
+            mode = 0o644
+        os.chmod(tmp, mode)
+        binary = isinstance(_data, bytes)
+        with os.fdopen(fd, 'wb' if binary else 'w') as file:
+            file.writelines([_data] if binary else _data)
+        os.replace(tmp, _output)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
 def substitute(input_file, output_file, **data):
     filedata = open_read(input_file)
     for key, value in data.items():
@@ -0,0 +1,60 @@
+"""
+Themed versions of the xterm 256 color palette.  Colors 16-231 are a
+6x6x6 rgb cube and 232-255 a grayscale ramp; left alone they clash with
+a generated theme, so each one is mapped onto the theme instead:
+
+cube -- every cube color takes its hue and chroma from an inverse
+        distance blend of the two theme colors nearest to it in Lab
+        (found with one batched KDTree query), and its lightness from
+        halfway between the theme's and its own, so the cube keeps its
+        light to dark structure.
+ramp -- the grayscale ramp becomes a straight Lab interpolation from the
+        background (color 0) to the foreground (color 7).
+
+Mappings are cached per palette.
+"""
+import functools
+
+import colorspace
+from color_functions import Palette
+from kdtree import KDTree
+from utility import lazy_import
+
+np = lazy_import('numpy')
+
+CUBE_LEVELS = (0, 95, 135, 175, 215, 255)
+# how much of the stock cube color's lightness to keep
+KEEP_LIGHTNESS = 0.5
+
+
+def stock_colors():
+    """rgb values of xterm colors 16-255, as a (240, 3) array"""
+    levels = np.array(CUBE_LEVELS)
+    cube = np.stack(np.meshgrid(levels, levels, levels, indexing='ij'),
+                    axis=-1).reshape(-1, 3)
+    gray = np.repeat(np.arange(8, 248, 10)[:, None], 3, axis=1)
+    return np.concatenate([cube, gray]).astype(np.uint8)
+
+
+@functools.lru_cache(maxsize=32)
+def _extended(hex_colors):
+    palette = Palette.from_hex(list(hex_colors))
+    theme = palette.lab[:16]
+    # the gray ramp is rebuilt from the theme, only the cube is blended
+    cube = colorspace.rgb_to_lab(stock_colors()[:216])
+
+    distances, nearest = KDTree(theme).query_batch(cube, k=2)
+    weights = 1 / np.maximum(distances, 1e-6)
+    weights /= weights.sum(axis=1, keepdims=True)
+    blend = (theme[nearest] * weights[..., None]).sum(axis=1)
+    blend[:, 0] += (cube[:, 0] - blend[:, 0]) * KEEP_LIGHTNESS
+
+    steps = np.linspace(0, 1, 24)[:, None]
+    ramp = theme[0] + (theme[7] - theme[0]) * steps
+
+    return Palette(colorspace.lab_to_rgb(np.concatenate([blend, ramp])))
+
+
+def extended_colors(colors):
+    """themed colors for xterm indices 16-255, as a 240 color Palette"""
+    return _extended(tuple(Palette.from_colors(colors).hex))